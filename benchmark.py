@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+'''Benchmark the matching hot path using recorded fixtures.
+
+Runs offline, no database or network needed. Fixtures are JSON files in
+benchmark/fixtures, record more with: flask benchmark_fixture PLACE FILENAME
+
+    ./benchmark.py                  compare with benchmark/baseline.json
+    ./benchmark.py --save-baseline  store the results as the new baseline
+'''
+
+from flask import Flask
+from matcher import match, matcher
+from matcher.model import Item
+from matcher.place import Place  # noqa: F401
+from time import perf_counter
+import argparse
+import json
+import os.path
+import sys
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+fixture_dir = os.path.join(base_dir, 'benchmark', 'fixtures')
+baseline_filename = os.path.join(base_dir, 'benchmark', 'baseline.json')
+default_rounds = 5
+min_round_seconds = 0.5  # repeat the fixtures until a round takes this long
+default_tolerance = 0.2  # fraction slower than baseline that counts as a regression
+
+def item_from_fixture(detail):
+    item = Item(item_id=int(detail['qid'][1:]),
+                entity=detail['entity'],
+                tags=detail['tags'],
+                categories=detail.get('categories'),
+                extract_names=detail.get('extract_names'))
+    if detail.get('extract'):
+        item.extract = detail['extract']
+
+    # these need the database, use the recorded values instead
+    place_names = set(detail.get('place_names', []))
+    isa_endings = set(detail.get('isa_endings', []))
+    item.place_names = lambda: place_names
+    item.more_endings_from_isa = lambda: isa_endings
+    return item
+
+def load_fixtures(directory=fixture_dir):
+    fixtures = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.json'):
+            continue
+        for detail in json.load(open(os.path.join(directory, filename))):
+            item = item_from_fixture(detail)
+            rows = [tuple(row) for row in detail['rows']]
+            expect = [tuple(c) for c in detail['expect']]
+            fixtures.append((item, rows, expect))
+    return fixtures
+
+class MatchInput:
+    ''' Details of an item used by the matcher, worked out before timing. '''
+    def __init__(self, item, rows):
+        self.item = item
+        self.rows = rows
+        self.names = item.names() or {}
+        self.endings = (matcher.get_ending_from_criteria(item.tags) |
+                        item.more_endings_from_isa())
+        self.place_names = item.place_names()
+        self.osm_tags = [row[3] for row in rows]
+
+def clear_caches():
+    for f in (match.tidy_name, match.normalize_name,
+              match.strip_non_chars, match.name_match_keys):
+        f.cache_clear()
+
+def bench_name_match(inputs):
+    count = 0
+    for i in inputs:
+        for osm_tags in i.osm_tags:
+            for osm_name in match.get_names(osm_tags).values():
+                for wd_name in i.names:
+                    match.name_match(osm_name, wd_name, i.endings,
+                                     place_names=i.place_names)
+                    count += 1
+    return count
+
+def bench_check_for_match(inputs):
+    count = 0
+    for i in inputs:
+        for osm_tags in i.osm_tags:
+            match.check_for_match(osm_tags, i.names, i.endings,
+                                  place_names=i.place_names)
+            count += 1
+    return count
+
+def bench_check_name_matches_address(inputs):
+    count = 0
+    for i in inputs:
+        for osm_tags in i.osm_tags:
+            match.check_name_matches_address(osm_tags, i.names)
+            count += 1
+    return count
+
+def bench_filter_candidate_rows(inputs):
+    for i in inputs:
+        matcher.filter_candidate_rows(i.item, i.rows)
+    return len(inputs)
+
+benchmarks = [
+    ('name_match', bench_name_match, 'pairs'),
+    ('check_for_match', bench_check_for_match, 'pairs'),
+    ('check_name_matches_address', bench_check_name_matches_address, 'pairs'),
+    ('find_item_matches', bench_filter_candidate_rows, 'items'),
+]
+
+def check_results(fixtures):
+    ''' Candidates found should match those recorded with the fixture. '''
+    errors = []
+    for item, rows, expect in fixtures:
+        found = [(c['osm_type'], c['osm_id'])
+                 for c in matcher.filter_candidate_rows(item, rows)]
+        if found != expect:
+            errors.append(f'Q{item.item_id}: expected {expect}, found {found}')
+    return errors
+
+def run_benchmarks(fixtures, rounds=default_rounds):
+    inputs = [MatchInput(item, rows) for item, rows, expect in fixtures]
+    results = {}
+    for name, func, unit in benchmarks:
+        best = None
+        for _ in range(rounds):
+            count = 0
+            seconds = 0
+            while seconds < min_round_seconds:
+                clear_caches()  # caches start empty, as in a matcher run
+                t0 = perf_counter()
+                count += func(inputs)
+                seconds += perf_counter() - t0
+            rate = count / seconds
+            if best is None or rate > best:
+                best = rate
+        results[name] = {'rate': best, 'unit': unit + '/sec'}
+    return results
+
+def compare(results, baseline, tolerance=default_tolerance):
+    regressions = []
+    for name, result in results.items():
+        line = f'{name:30s} {result["rate"]:14,.0f} {result["unit"]:10s}'
+        if name in baseline:
+            change = result['rate'] / baseline[name]['rate'] - 1
+            line += f' baseline {baseline[name]["rate"]:14,.0f} {change:+7.1%}'
+            if change < -tolerance:
+                regressions.append(name)
+                line += '  REGRESSION'
+        print(line)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the matcher.')
+    parser.add_argument('--rounds', type=int, default=default_rounds)
+    parser.add_argument('--tolerance', type=float, default=default_tolerance)
+    parser.add_argument('--fixtures', default=fixture_dir)
+    parser.add_argument('--baseline', default=baseline_filename)
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+
+    app = Flask('benchmark')
+    app.config['DATA_DIR'] = os.path.join(base_dir, 'data')
+
+    with app.app_context():
+        fixtures = load_fixtures(args.fixtures)
+        print(f'{len(fixtures):,d} items, '
+              f'{sum(len(rows) for item, rows, expect in fixtures):,d} OSM candidates')
+
+        errors = check_results(fixtures)
+        for error in errors:
+            print('result changed:', error)
+
+        results = run_benchmarks(fixtures, rounds=args.rounds)
+
+    if args.save_baseline:
+        json.dump(results, open(args.baseline, 'w'), indent=2, sort_keys=True)
+        compare(results, {})
+        print('baseline saved:', args.baseline)
+        return 1 if errors else 0
+
+    baseline = (json.load(open(args.baseline))
+                if os.path.exists(args.baseline) else {})
+    regressions = compare(results, baseline, tolerance=args.tolerance)
+    return 1 if errors or regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+'''Benchmark netstring messages between the task queue and the websocket.
+
+Sends JSON messages like those of an Overpass request over a socket pair,
+the other end replies with an ack to every message, as in overpass_request.
+The byte at a time implementation is kept here for comparison.
+
+    ./benchmark_netstring.py
+'''
+
+from matcher import netstring
+from time import perf_counter
+import argparse
+import json
+import socket
+import threading
+
+default_count = 20_000
+
+def unbuffered_write(sock, to_send):
+    sock.sendall(b'%d' % len(to_send))
+    sock.sendall(b':')
+    sock.sendall(to_send.encode('utf-8'))
+    sock.sendall(b',')
+
+def unbuffered_read(sock):
+    char = sock.recv(1)
+    if char == b'':
+        return
+    buf = b''
+    while char != b':':
+        buf += char
+        char = sock.recv(1)
+    byte_len = int(buf.decode('ASCII'))
+    buf = b''
+    while len(buf) < byte_len:
+        buf += sock.recv(byte_len - len(buf))
+    char = sock.recv(1)
+    assert char == b','
+    return buf.decode('utf-8')
+
+def sample_messages(count):
+    place = {'place_id': 123456, 'osm_id': 62149, 'osm_type': 'relation'}
+    return [json.dumps({'type': 'chunk', 'num': num, 'place': place,
+                        'filename': f'{place["place_id"]}_{num:03d}_100.xml'})
+            for num in range(count)]
+
+def ack_client(sock, read, write):
+    while read() is not None:
+        write(sock, 'ack')
+    sock.close()
+
+def run(messages, server_side, client_side):
+    server, client = socket.socketpair()
+    t = threading.Thread(target=client_side, args=(client,))
+    t.start()
+    t0 = perf_counter()
+    server_side(server, messages)
+    seconds = perf_counter() - t0
+    server.close()
+    t.join()
+    return len(messages) / seconds
+
+def before(messages):
+    def server_side(sock, messages):
+        for msg in messages:
+            unbuffered_write(sock, msg)
+            assert unbuffered_read(sock) == 'ack'
+
+    def client_side(sock):
+        ack_client(sock, lambda: unbuffered_read(sock), unbuffered_write)
+
+    return run(messages, server_side, client_side)
+
+def after(messages, batch=1):
+    def server_side(sock, messages):
+        reader = netstring.Reader(sock)
+        for i in range(0, len(messages), batch):
+            msgs = messages[i:i + batch]
+            netstring.write_many(sock, msgs)
+            for _ in msgs:
+                assert reader.read() == 'ack'
+
+    def client_side(sock):
+        ack_client(sock, netstring.Reader(sock).read, netstring.write)
+
+    return run(messages, server_side, client_side)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark netstrings.')
+    parser.add_argument('--count', type=int, default=default_count)
+    args = parser.parse_args()
+
+    messages = sample_messages(args.count)
+    results = [
+        ('byte at a time', before(messages)),
+        ('buffered', after(messages)),
+        ('buffered, pipelined acks', after(messages, batch=100)),
+    ]
+    for name, rate in results:
+        print(f'{name:30s} {rate:12,.0f} messages/sec')
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 from flask import render_template
 from .view import app, get_top_existing, get_existing
-from .model import Item, Changeset, get_bad, Base, ItemCandidate, Language, LanguageLabel, PlaceItem, OsmCandidate, ChangesetEdit
+from .model import Item, IsA, Changeset, get_bad, Base, ItemCandidate, Language, LanguageLabel, PlaceItem, OsmCandidate, ChangesetEdit
 from .place import Place
 from . import database, mail, matcher, nominatim, utils, netstring, wikidata, osm_api
 from social.apps.flask_app.default.models import UserSocialAuth, Nonce, Association
@@ -270,13 +270,52 @@ def run_matcher(place_identifier):
 @app.cli.command()
 @click.argument('place_identifier')
 @click.option('--debug', is_flag=True)
-def place_match(place_identifier, debug):
+@click.option('--workers', type=int)
+def place_match(place_identifier, debug, workers):
     place = get_place(place_identifier)
     place_items = place.matcher_query()
     total = place_items.count()
     print('total:', total)
 
-    place.run_matcher(debug=debug)
+    place.run_matcher(debug=debug, workers=workers)
+
+@app.cli.command()
+@click.argument('place_identifier')
+@click.argument('filename')
+@click.option('--limit', type=int, default=200)
+def benchmark_fixture(place_identifier, filename, limit):
+    ''' Record items and OSM candidate rows for benchmark.py '''
+    place = get_place(place_identifier)
+    items = (place.items.filter(Item.entity.isnot(None))
+                        .order_by(Item.item_id)
+                        .limit(limit)
+                        .all())
+    conn = database.session.bind.raw_connection()
+    cur = conn.cursor()
+
+    fixture = []
+    for item, rows in matcher.batch_candidate_rows(cur, items, place.prefix):
+        if not rows:
+            continue
+        candidates = matcher.filter_candidate_rows(item, rows)
+        entity = {k: v for k, v in item.entity.items()
+                  if k in ('labels', 'aliases', 'sitelinks', 'claims')}
+        fixture.append({
+            'qid': item.qid,
+            'entity': entity,
+            'tags': sorted(item.tags),
+            'categories': item.categories,
+            'extract_names': item.extract_names,
+            'extract': item.extract,
+            'place_names': sorted(item.place_names()),
+            'isa_endings': sorted(item.more_endings_from_isa()),
+            'rows': [list(row) for row in rows],
+            'expect': [[c['osm_type'], c['osm_id']] for c in candidates],
+        })
+    conn.close()
+
+    json.dump(fixture, open(filename, 'w'), indent=1)
+    print(f'{len(fixture):,d} items saved to {filename}')
 
 @app.cli.command()
 @click.argument('place_identifier')
@@ -374,10 +413,9 @@ def add_to_queue(place_identifier):
     }
 
     netstring.write(sock, json.dumps(msg))
-    reply = netstring.read(sock)
-    print(reply)
+    reader = netstring.Reader(sock)
     while True:
-        from_network = netstring.read(sock)
+        from_network = reader.read()
         print('from network:', from_network)
         if from_network is None:
             break
@@ -996,3 +1034,40 @@ def refresh_all_extracts():
 
         place.load_extracts(progress=progress)
         print()
+
+# schema changes for databases created before the columns were added
+upgrade_sql = [
+    'alter table item add column if not exists lastrevid integer',
+    'alter table isa add column if not exists lastrevid integer',
+    'alter table place add column if not exists failed_chunks json',
+    'alter table place_item add column if not exists fingerprint text',
+    'alter table item alter column entity type jsonb using entity::jsonb',
+    'alter table isa alter column entity type jsonb using entity::jsonb',
+]
+
+@app.cli.command()
+@click.option('--batch-size', type=int, default=1000)
+def compact_entities(batch_size):
+    ''' Upgrade an existing database: add new columns, convert stored
+    entities to JSONB and the compact projection. '''
+    app.config.from_object('config.default')
+    database.init_app(app)
+
+    for sql in upgrade_sql:
+        database.session.execute(sql)
+    database.session.commit()
+
+    for cls in Item, IsA:
+        q = (cls.query.filter(cls.entity.isnot(None))
+                      .filter(cls.entity['projection'].astext.is_distinct_from(
+                              str(wikidata.entity_projection_version))))
+        count = 0
+        while True:
+            batch = q.limit(batch_size).all()
+            if not batch:
+                break
+            for obj in batch:
+                obj.set_entity(obj.entity)
+            database.session.commit()
+            count += len(batch)
+            print(cls.__tablename__, count)
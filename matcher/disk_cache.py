@@ -0,0 +1,121 @@
+'''Content-addressed file cache with a byte budget.
+
+Entries are files named by the hash of their key. An SQLite index records
+when each entry was created and last used, its size and TTL. Once the total
+size goes over the budget the least recently used entries are removed.
+'''
+
+from flask import current_app, has_app_context
+from collections import namedtuple
+import hashlib
+import os
+import os.path
+import shutil
+import sqlite3
+import threading
+import time
+
+Hit = namedtuple('Hit', ['filename', 'fresh', 'expires'])
+caches = {}
+
+def hash_key(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def app_cache(name, budget, ttl):
+    ''' Cache set by the NAME_CACHE_DIR, NAME_CACHE_BYTES and NAME_CACHE_TTL
+    config, the directory defaults to CACHE_DIR/name. None outside the app or
+    without a directory. '''
+    if not has_app_context():
+        return
+    config = current_app.config
+    prefix = name.upper() + '_CACHE_'
+    directory = config.get(prefix + 'DIR')
+    if not directory and config.get('CACHE_DIR'):
+        directory = os.path.join(config['CACHE_DIR'], name)
+    if not directory:
+        return
+    if directory not in caches:
+        caches[directory] = DiskCache(directory,
+                                      config.get(prefix + 'BYTES', budget),
+                                      config.get(prefix + 'TTL', ttl))
+    return caches[directory]
+
+class DiskCache:
+    def __init__(self, directory, budget, ttl):
+        self.directory = directory
+        self.budget = budget
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+        index = os.path.join(directory, 'index.sqlite')
+        self.db = sqlite3.connect(index, timeout=30, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute('create table if not exists entry '
+                        '(key text primary key, created real, last_used real, '
+                        'size integer, ttl real)')
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def lookup(self, key):
+        ''' Cached file and whether it is within its TTL, or None. '''
+        row = self.db.execute('select created, ttl from entry where key = ?',
+                              (key,)).fetchone()
+        filename = self.path(key)
+        if not row or not os.path.exists(filename):
+            return
+        now = time.time()
+        self.db.execute('update entry set last_used = ? where key = ?',
+                        (now, key))
+        created, ttl = row
+        return Hit(filename, now < created + ttl, created + ttl)
+
+    def tmp_path(self, key):
+        dest = self.path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        # several threads can store the same key
+        return dest, '{}.{}.{}.tmp'.format(dest, os.getpid(), threading.get_ident())
+
+    def store(self, key, data, ttl=None):
+        dest, tmp = self.tmp_path(key)
+        with open(tmp, 'wb') as out:
+            out.write(data)
+        os.replace(tmp, dest)
+        self.add_entry(key, len(data), ttl)
+
+    def store_file(self, key, filename, ttl=None):
+        ''' Add a copy of a file, as a hard link where the filesystem allows. '''
+        dest, tmp = self.tmp_path(key)
+        try:
+            os.link(filename, tmp)
+        except OSError:
+            shutil.copyfile(filename, tmp)
+        os.replace(tmp, dest)
+        self.add_entry(key, os.path.getsize(dest), ttl)
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+        self.db.execute('delete from entry where key = ?', (key,))
+
+    def add_entry(self, key, size, ttl):
+        now = time.time()
+        self.db.execute('insert or replace into entry values (?, ?, ?, ?, ?)',
+                        (key, now, now, size, ttl or self.ttl))
+        self.evict()
+
+    def total_size(self):
+        return self.db.execute('select coalesce(sum(size), 0) from entry').fetchone()[0]
+
+    def evict(self):
+        ''' Remove least recently used entries until within the budget. '''
+        total = self.total_size()
+        if total <= self.budget:
+            return
+        rows = self.db.execute('select key, size from entry order by last_used')
+        for key, size in rows.fetchall():
+            if total <= self.budget:
+                break
+            self.delete(key)
+            total -= size
@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 from collections import defaultdict
+from functools import lru_cache
 from unidecode import unidecode
 from num2words import num2words
 from .utils import remove_start, normalize_url, any_upper
@@ -43,6 +44,9 @@ re_abbr = re.compile(r'\b(' + '|'.join(abbr.keys()) + r')\b', re.I)
 
 re_address_common_end = re.compile('^(.+)(' + '|'.join(abbr.keys()) + '|plaza)$', re.I)
 
+# names repeat across candidates and items, normalized versions are cached
+name_cache_size = 100_000
+
 bad_name_fields = {'tiger:name_base', 'name:right',
                    'name:left', 'gnis:county_name', 'openGeoDB:name'}
 
@@ -57,6 +61,7 @@ class Match(object):
         self.osm_name = None
         self.osm_key = None
 
+@lru_cache(maxsize=name_cache_size)
 def tidy_name(n):
     # expects to be passed a name in lowercase
     n = n.replace('saint ', 'st ')
@@ -98,12 +103,17 @@ def initials_match(n1, n2, endings=None):
             [n1[:-len(end)].strip() for end in endings or [] if n1_lc.endswith(end.lower())]):
         return Match(MatchType.initials_trim)
 
+@lru_cache(maxsize=name_cache_size)
+def strip_non_chars(s, dash_okay=True):
+    pattern = re_strip_non_chars if dash_okay else re_strip_non_chars_and_dash
+    return pattern.sub('', s)
+
 def match_with_words_removed(osm, wd, words):
     if not words:
         return
-    wd_char_only = re_strip_non_chars.sub('', wd)
-    osm_char_only = re_strip_non_chars.sub('', osm)
-    words = [re_strip_non_chars.sub('', w) for w in words]
+    wd_char_only = strip_non_chars(wd)
+    osm_char_only = strip_non_chars(osm)
+    words = [strip_non_chars(w) for w in words]
     osm_versions = {osm_char_only.replace(word, '')
                     for word in words} | {osm_char_only}
     wd_versions = {wd_char_only.replace(word, '')
@@ -123,10 +133,8 @@ def match_with_words_removed(osm, wd, words):
             return Match(match_type)
 
 def strip_non_chars_match(osm, wd, dash_okay=True):
-    pattern = re_strip_non_chars if dash_okay else re_strip_non_chars_and_dash
-
-    wc_stripped = pattern.sub('', wd)
-    osm_stripped = pattern.sub('', osm)
+    wc_stripped = strip_non_chars(wd, dash_okay)
+    osm_stripped = strip_non_chars(osm, dash_okay)
 
     return wc_stripped and osm_stripped and wc_stripped == osm_stripped
 
@@ -288,8 +296,8 @@ def name_match_main(osm, wd, endings=None, debug=False):
         if remove_start(wd_tidy[:comma], 'the ') == remove_start(osm_tidy, 'the '):
             return Match(MatchType.good)
 
-    wd_tidy = re_strip_non_chars.sub('', wd_tidy)
-    osm_tidy = re_strip_non_chars.sub('', osm_tidy)
+    wd_tidy = strip_non_chars(wd_tidy)
+    osm_tidy = strip_non_chars(osm_tidy)
     if wd_tidy == osm_tidy:
         return Match(MatchType.good)
 
@@ -371,10 +379,16 @@ def name_match(osm, wd, endings=None, debug=False, place_names=None):
         if match:
             return match
 
+@lru_cache(maxsize=name_cache_size)
 def normalize_name(name):
     name = re_ordinal_number.sub(lambda m: num2words(int(m.group(1)), to='ordinal'), name)
     return re_strip_non_chars.sub('', name.lower())
 
+def name_cache_info():
+    ''' Hit and miss counts for the name normalization caches. '''
+    return {f.__name__: f.cache_info()
+            for f in (tidy_name, normalize_name, strip_non_chars, name_match_keys)}
+
 def has_address(osm_tags):
     return any('addr:' + part in osm_tags for part in ('housenumber', 'full'))
 
@@ -487,6 +501,118 @@ def get_names(osm_tags):
     return {k: v for k, v in osm_tags.items()
              if ('name' in k and k not in bad_name_fields) or k == 'operator'}
 
+def words_removed_versions(name, words):
+    ''' Versions of the name compared by match_with_words_removed. '''
+    char_only = strip_non_chars(name)
+    return {char_only.replace(strip_non_chars(w), '') for w in words} | {char_only}
+
+def name_match_main_keys(name, endings):
+    ''' Keys for the comparisons made by name_match_main.
+
+    If name_match_main matches two names then they have at least one key in
+    common. Each step of the cascade contributes the strings it compares.'''
+    keys = set()
+
+    def add(*strings):
+        keys.update(('str', s) for s in strings)
+
+    lc = name.lower()
+    add(name, strip_non_chars(lc), strip_non_chars(lc, dash_okay=False))
+    keys.add(('tokens', frozenset(lc.split())))
+
+    upper = ''.join(c for c in name if c.isupper())
+    if len(upper) >= 2:  # name_containing_initials
+        keys.add(('upper', upper))
+
+    # initials_match: initials of one name compared with the other name
+    initials = ''.join(term[0] for term in name.split() if term[0].isalnum()).upper()
+    if len(initials) >= 3:
+        keys.add(('initials', initials))
+    if len(name) >= 3:
+        keys.add(('initials', name))
+        keys.add(('initials', ''.join(c for c in name if c.isalnum())))
+        for end in endings or []:
+            trimmed = name[:-len(end)].strip()
+            if lc.endswith(end.lower()) and len(trimmed) >= 3:
+                keys.add(('initials', trimmed))
+
+    endings = set(endings or []) | {'house'}
+    add(*words_removed_versions(lc, endings))
+
+    tidy = tidy_name(lc)
+    add(*words_removed_versions(tidy, [tidy_name(e) for e in endings]))
+
+    for t in {tidy, tidy.replace('washington, d', 'washington d')}:
+        add(t, strip_non_chars(t, dash_okay=False))
+        keys.add(('tokens', frozenset(t.split())))
+        comma = t.rfind(', ')
+        if comma != -1:
+            add(t[:comma], strip_non_chars(t[:comma]))
+
+        t = re_keep_commas.sub('', t)
+        add(t, remove_start(t, 'the '))
+        comma = t.rfind(', ')
+        if comma != -1:
+            add(t[:comma], remove_start(t[:comma], 'the '))
+
+        t = strip_non_chars(t)
+        add(t)
+        if t.startswith('the'):
+            t = t[3:]
+            add(t)
+
+        for end in ['building', 'complex', 'house'] + list(endings):
+            if t.endswith(end):
+                add(t[:-len(end)])
+            if t.startswith(end):
+                add(t[len(end):])
+
+    return keys
+
+def osm_name_match_versions(osm, place_names):
+    ''' Versions of an OSM name that name_match passes to name_match_main. '''
+    versions = {osm}
+    osm_no_intitals = drop_initials(osm)
+    if osm_no_intitals:
+        versions.add(osm_no_intitals)
+    start = 'site of'
+    if osm.lower().startswith(start):
+        versions.add(osm[len(start):])
+    for place_name in place_names:
+        versions.add(strip_place_name(osm, place_name))
+    if ';' in osm:
+        for osm_name in osm.split(';'):
+            versions |= osm_name_match_versions(osm_name.strip(), place_names)
+    return versions
+
+def wikidata_name_match_versions(wd, place_names):
+    ''' Versions of a Wikidata name that name_match passes to name_match_main. '''
+    versions = {wd}
+    for start in 'Tomb of ', 'Statue of ', 'Memorial to ':
+        if wd.startswith(start):
+            versions.add(wd[len(start):])
+    end = ' And Attached Railings'.lower()
+    if wd.lower().endswith(end):
+        versions.add(wd[:-len(end)])
+    for place_name in place_names:
+        versions.add(strip_place_name(wd, place_name))
+    return versions
+
+@lru_cache(maxsize=name_cache_size)
+def name_match_keys(name, is_osm, endings, place_names):
+    ''' Blocking keys for name_match, names with no keys in common can't match.
+
+    endings and place_names are frozensets so the result can be cached. '''
+    place_names = more_place_name_varients(place_names)
+    if is_osm:
+        versions = osm_name_match_versions(name, place_names)
+    else:
+        versions = wikidata_name_match_versions(name, place_names)
+    keys = set()
+    for version in versions:
+        keys |= name_match_main_keys(version, endings)
+    return frozenset(keys)
+
 def intials_matches_other_wikidata_name(initials, wikidata_names):
     return any(w != initials and initials_match(initials, w)
                for w in wikidata_names.keys())
@@ -512,10 +638,29 @@ def check_for_match(osm_tags, wikidata_names, endings=None, place_names=None):
             'a ' + city,   # Italian
         }
 
+    # blocking: only run name_match for OSM names that share a key with the
+    # Wikidata name, other pairs can't match
+    endings_key = frozenset(endings or [])
+    place_names_key = frozenset(place_names or [])
+    key_to_wikidata = defaultdict(set)
+    for w in wikidata_names.keys():
+        for key in name_match_keys(w, False, endings_key, place_names_key):
+            key_to_wikidata[key].add(w)
+
+    possible = {}
+    for o in names.values():
+        keys = name_match_keys(o, True, endings_key, place_names_key)
+        if operator and o.lower().startswith(operator):
+            keys |= name_match_keys(o[len(operator):].rstrip(), True,
+                                    endings_key, place_names_key)
+        possible[o] = set().union(*(key_to_wikidata.get(key, ()) for key in keys))
+
     name = defaultdict(list)
     cache = {}
     for w, source in wikidata_names.items():
         for osm_key, o in names.items():
+            if w not in possible[o]:
+                continue
             if (o, w) in cache:
                 result = cache[(o, w)]
                 if not result:
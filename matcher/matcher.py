@@ -1,52 +1,80 @@
 from flask import current_app
 from collections import Counter, defaultdict
+from itertools import groupby
 from . import match, database
 
 import os.path
+import hashlib
 import json
 import re
 
 cat_to_ending = {}
-patterns = {}
-entity_types = {}
+entity_type_index = None
+category_classifier = None
+re_word = re.compile(r'\w+')
 default_max_dist = 4
 
-def get_pattern(key):
-    if key in patterns:
-        return patterns[key]
-    return patterns.setdefault(key, re.compile(r'\b' + re.escape(key) + r'\b', re.I))
+# candidate geometry with more points than this is simplified before saving
+simplify_geom_points = 2000
+simplify_geom_tolerance = 1  # metres
+
+class CategoryClassifier:
+    '''Find the entity types that match a Wikipedia category.
+
+    Category keys are indexed by their first word, so each word in a
+    category is checked against the few keys that start with it, rather
+    than every key being searched for in every category.'''
+
+    def __init__(self, cat_to_entity):
+        self.by_first_word = defaultdict(list)
+        for key, value in cat_to_entity.items():
+            first_word = re_word.match(key).group()
+            pattern = re.compile(re.escape(key) + r'\b', re.I)
+            self.by_first_word[first_word].append((pattern, value))
+
+        self.exclude = {}
+        for value in cat_to_entity.values():
+            exclude = value.get('exclude_cats')
+            if exclude and id(value) not in self.exclude:
+                self.exclude[id(value)] = re.compile(r'\b(' + '|'.join(re.escape(e) for e in exclude) + r')\b', re.I)
+
+    def tags(self, cat):
+        lc_cat = cat.lower()
+        tags = set()
+        for word in re_word.finditer(lc_cat):
+            for pattern, value in self.by_first_word.get(word.group(), []):
+                if not pattern.match(lc_cat, word.start()):
+                    continue
+                exclude = self.exclude.get(id(value))
+                if exclude and exclude.search(lc_cat):
+                    continue
+                tags |= set(value['tags'])
+        return tags
+
+def get_category_classifier():
+    global category_classifier
+
+    if category_classifier is None:
+        category_classifier = CategoryClassifier(build_cat_map())
+    return category_classifier
 
 def categories_to_tags(categories, cat_to_entity=None):
     if cat_to_entity is None:
-        cat_to_entity = build_cat_map()
+        classifier = get_category_classifier()
+    else:
+        classifier = CategoryClassifier(cat_to_entity)
     tags = set()
     for cat in categories:
-        lc_cat = cat.lower()
-        for key, value in cat_to_entity.items():
-            if not get_pattern(key).search(lc_cat):
-                continue
-            exclude = value.get('exclude_cats')
-            if exclude:
-                pattern = re.compile(r'\b(' + '|'.join(re.escape(e) for e in exclude) + r')\b', re.I)
-                if pattern.search(lc_cat):
-                    continue
-            tags |= set(value['tags'])
+        tags |= classifier.tags(cat)
     return sorted(tags)
 
 def categories_to_tags_map(categories):
-    cat_to_entity = build_cat_map()
+    classifier = get_category_classifier()
     ret = defaultdict(set)
     for cat in categories:
-        lc_cat = cat.lower()
-        for key, value in cat_to_entity.items():
-            if not get_pattern(key).search(lc_cat):
-                continue
-            exclude = value.get('exclude_cats')
-            if exclude:
-                pattern = re.compile(r'\b(' + '|'.join(re.escape(e) for e in exclude) + r')\b', re.I)
-                if pattern.search(lc_cat):
-                    continue
-            ret[cat] |= set(value['tags'])
+        tags = classifier.tags(cat)
+        if tags:
+            ret[cat] |= tags
     return ret
 
 def load_entity_types():
@@ -84,19 +112,58 @@ def build_cat_map():
             cat_to_entity[lc_cat] = i
     return cat_to_entity
 
-def get_ending_from_criteria(tags):
-    global entity_types
+class EntityTypeIndex:
+    '''Lookups over entity_types.json, built once per process.'''
+
+    def __init__(self, entity_types):
+        self.entity_types = entity_types
+        self.by_tag = defaultdict(list)
+        self.by_qid = defaultdict(list)
+        for num, t in enumerate(entity_types):
+            for tag in set(t['tags']):
+                self.by_tag[tag].append(num)
+            if t.get('wikidata'):
+                self.by_qid[t['wikidata']].append(num)
+
+        self.endings = [set(t.get('trim', [])) for t in entity_types]
+        self.dist = [t.get('dist') for t in entity_types]
+        self.check_housename = [bool(t.get('check_housename'))
+                                for t in entity_types]
+
+    def types_for_tags(self, tags):
+        return {num for tag in set(tags) for num in self.by_tag.get(tag, [])}
+
+    def types_for_qids(self, qids):
+        return {num for qid in set(qids) for num in self.by_qid.get(qid, [])}
 
-    if not entity_types:
-        entity_types = load_entity_types()
-    tags = set(tags)
+    def endings_for_tags(self, tags):
+        endings = set()
+        for num in self.types_for_tags(tags):
+            endings |= self.endings[num]
+        return endings
 
-    endings = set()
-    for t in entity_types:
-        if tags & set(t['tags']):
-            endings.update(t.get('trim', []))
+    def max_dist_for_tags(self, tags):
+        max_dists = [self.dist[num] for num in self.types_for_tags(tags)
+                     if self.dist[num]]
+        return max(max_dists) if max_dists else None
 
-    return endings
+    def could_be_building(self, tags, instanceof):
+        if instanceof:
+            from_instanceof = self.types_for_qids(instanceof)
+            if from_instanceof:
+                return any(self.check_housename[num] for num in from_instanceof)
+
+        return any(self.check_housename[num] for num in self.types_for_tags(tags))
+
+def get_entity_type_index():
+    global entity_type_index
+
+    if entity_type_index is None:
+        entity_type_index = EntityTypeIndex(load_entity_types())
+    return entity_type_index
+
+def get_ending_from_criteria(tags):
+    return get_entity_type_index().endings_for_tags(tags)
 
 def could_be_building(tags, instanceof):
     place_tags = {'place', 'place=neighbourhood', 'landuse=residential',
@@ -107,41 +174,10 @@ def could_be_building(tags, instanceof):
     if any(tag.startswith('building') for tag in tags):
         return True
 
-    global entity_types
-
-    if not entity_types:
-        entity_types = load_entity_types()
-
-    check_housename = False
-    found_instanceof = False
-    if instanceof:
-        for t in entity_types:
-            if t.get('wikidata') not in instanceof:
-                continue
-            found_instanceof = True
-            if t.get('check_housename'):
-                check_housename = True
-    if found_instanceof:
-        return check_housename
-
-    tags = set(tags)
-    return any(t.get('check_housename') and tags & set(t['tags'])
-               for t in entity_types)
+    return get_entity_type_index().could_be_building(tags, instanceof)
 
 def get_max_dist_from_criteria(tags):
-    global entity_types
-
-    if not entity_types:
-        entity_types = load_entity_types()
-    tags = set(tags)
-
-    max_dists = []
-    for t in entity_types:
-        type_max_dist = t.get('dist')
-        if type_max_dist and tags & set(t['tags']):
-            max_dists.append(type_max_dist)
-
-    return max(max_dists) if max_dists else None
+    return get_entity_type_index().max_dist_for_tags(tags)
 
 def hstore_query(tags):
     '''hstore query for use with osm2pgsql database'''
@@ -159,6 +195,19 @@ def hstore_query(tags):
 
     return ' or\n '.join(cond)
 
+def search_criteria(tags):
+    '''(key, value) pairs equivalent to hstore_query, value is None for a key'''
+    criteria = []
+    for tag in tags:
+        if '=' not in tag:
+            criteria.append((tag, None))
+            continue
+        k, _, v = tag.partition('=')
+        criteria.append((k, v))
+        if '_' in v:
+            criteria.append((k, v.replace('_', ' ')))
+    return criteria
+
 def nearby_nodes_sql(item, prefix, max_dist=10, limit=50):
     point = f"ST_TRANSFORM(ST_GeomFromEWKT('{item.ewkt}'), 3857)"
     sql = (f"select 'point', osm_id, name, tags, "
@@ -189,6 +238,173 @@ def item_match_sql(item, prefix, ignore_tags=None, limit=50):
             f') a where ({hstore}) order by dist limit {limit}')
     return sql
 
+def batch_item_match_sql(prefix, nearby_dist=10, limit=50):
+    '''Candidate search for many items in a single query.
+
+    Item points, search radius and tag criteria are passed as arrays, see
+    batch_item_match_params. Rows come back ordered by item number, then tag
+    matches ordered by distance, followed by nodes near the item point.'''
+
+    union = ' union '.join(
+        f"select '{obj_type}' as src_type, osm_id, name, tags, "
+        f'ST_Distance(i.point, way) as dist '
+        f'from {prefix}_{obj_type} '
+        f'where ST_DWithin(i.point, way, i.max_dist)'
+        for obj_type in ('point', 'line', 'polygon'))
+
+    return f'''
+with i as (
+    select num, ST_Transform(ST_GeomFromEWKT(ewkt), 3857) as point, max_dist
+    from unnest(%(ewkt)s::text[], %(max_dist)s::float8[])
+        with ordinality as t(ewkt, max_dist, num)
+), c as (
+    select num, k, v
+    from unnest(%(criteria_num)s::bigint[],
+                %(criteria_key)s::text[],
+                %(criteria_value)s::text[]) as t(num, k, v)
+)
+select i.num, 0 as part, a.*
+from i cross join lateral (
+    select * from ({union}) b
+    where exists (
+        select 1 from c
+        where c.num = i.num and
+            case when c.v is null then b.tags ? c.k
+            else c.v = any(string_to_array((b.tags->c.k), ';')) end)
+    order by dist limit {limit}) a
+union all
+select i.num, 1 as part, 'point', osm_id, name, tags,
+    ST_Distance(i.point, way) as dist
+from i join {prefix}_point on ST_DWithin(i.point, way, {nearby_dist})
+order by num, part, dist'''
+
+def search_radius(item):
+    '''Distance in metres from the item location to search for candidates.'''
+    return (get_max_dist_from_criteria(item.tags) or default_max_dist) * 1000
+
+def item_fingerprint(item):
+    '''Hash of the item details used by the matcher.
+
+    When the fingerprint is unchanged, and the OSM data within the search
+    radius is unchanged, the matcher would find the same candidates.'''
+
+    detail = {
+        'location': item.ewkt,
+        'skip': item.skip_item_during_match(),
+        'names': item.names(),
+        'tags': item.tags,
+        'search_tags': item.calculate_tags(),
+        'categories': item.categories,
+        'identifiers': item.get_item_identifiers(),
+        'instanceof': item.instanceof(),
+        'isa_endings': item.more_endings_from_isa(),
+        'place_names': item.place_names(),
+        'ref_nrhp': item.ref_nrhp(),
+    }
+    as_json = json.dumps(detail, sort_keys=True, default=sorted)
+    return hashlib.sha1(as_json.encode('utf-8')).hexdigest()
+
+def batch_item_match_params(items):
+    params = {
+        'ewkt': [],
+        'max_dist': [],
+        'criteria_num': [],
+        'criteria_key': [],
+        'criteria_value': [],
+    }
+    for num, item in enumerate(items, start=1):
+        params['ewkt'].append(item.ewkt)
+        params['max_dist'].append(search_radius(item))
+
+        ignore_tags = {'building'} if item.is_a_historic_district() else set()
+        tags = item.calculate_tags(ignore_tags=ignore_tags)
+        for k, v in search_criteria(tags):
+            params['criteria_num'].append(num)
+            params['criteria_key'].append(k)
+            params['criteria_value'].append(v)
+    return params
+
+def batch_candidate_rows(cur, items, prefix, debug=False):
+    '''Run the batch candidate search, yield (item, rows) in item order.
+
+    A server-side cursor is used so rows are streamed rather than loaded
+    into memory in one go.'''
+
+    if not items:
+        return
+    sql = batch_item_match_sql(prefix)
+    params = batch_item_match_params(items)
+    if debug:
+        print(sql)
+
+    rows_cur = cur.connection.cursor('batch_item_match')
+    rows_cur.itersize = 2000
+    try:
+        rows_cur.execute(sql, params)
+        grouped = groupby(rows_cur, key=lambda row: row[0])
+        row_num, group = next(grouped, (None, None))
+        for num, item in enumerate(items, start=1):
+            if row_num != num:
+                yield item, []
+                continue
+            yield item, [row[2:] for row in group]
+            row_num, group = next(grouped, (None, None))
+    finally:
+        rows_cur.close()
+
+def find_batch_item_matches(cur, items, prefix, debug=False):
+    '''Batch version of find_item_matches, one query for all the items.
+
+    Yields (item, candidates) in the same order as items.'''
+
+    searchable = [item for item in items
+                  if item and item.entity and item.names()]
+
+    found = {}
+    for item, rows in batch_candidate_rows(cur, searchable, prefix, debug):
+        if debug:
+            print('row count:', len(rows))
+            print()
+        if rows:
+            found[id(item)] = filter_candidate_rows(item, rows, debug)
+
+    add_candidate_geoms(cur, [c for candidates in found.values()
+                              for c in candidates], prefix)
+
+    for item in items:
+        yield item, found.get(id(item), [])
+
+def candidate_geom_sql(prefix, tables, simplify=True):
+    way = 'way'
+    if simplify:
+        way = (f'case when ST_NPoints(way) > {simplify_geom_points} '
+               f'then ST_SimplifyPreserveTopology(way, {simplify_geom_tolerance}) '
+               f'else way end')
+
+    return ' union all '.join(
+        f"select '{table}', osm_id, ST_AsText(ST_Transform({way}, 4326)) "
+        f'from {prefix}_{table} '
+        f'where osm_id = any(%({table})s::bigint[])'
+        for table in tables)
+
+def add_candidate_geoms(cur, candidates, prefix, simplify=True):
+    '''Load geometry for candidates with one query, instead of one per candidate.
+
+    Large geometries are simplified so they don't bloat ItemCandidate.geom.'''
+
+    src_ids = defaultdict(list)
+    for c in candidates:
+        src_ids[c['planet_table']].append(c['src_id'])
+    if not src_ids:
+        return
+
+    cur.execute(candidate_geom_sql(prefix, sorted(src_ids), simplify),
+                dict(src_ids))
+    geoms = {(table, src_id): geom for table, src_id, geom in cur.fetchall()}
+
+    for c in candidates:
+        c['geom'] = geoms.get((c['planet_table'], c['src_id']))
+
 def run_sql(cur, sql, debug=False):
     if debug:
         print(sql)
@@ -265,8 +481,6 @@ def find_item_matches(cur, item, prefix, debug=False):
     if not wikidata_names:
         return []
 
-    cats = item.categories or []
-
     # point = "ST_GeomFromEWKT('{}')".format(item.ewkt)
 
     # item_max_dist = max(max_dist[cat] for cat in item['cats'])
@@ -284,6 +498,16 @@ def find_item_matches(cur, item, prefix, debug=False):
     if debug:
         print('row count:', len(rows))
         print()
+
+    candidates = filter_candidate_rows(item, rows, debug)
+    add_candidate_geoms(cur, candidates, prefix)
+    return candidates
+
+def filter_candidate_rows(item, rows, debug=False):
+    wikidata_names = item.names()
+    cats = item.categories or []
+    item_is_a_historic_district = item.is_a_historic_district()
+
     seen = set()
 
     nrhp_numbers = item.ref_nrhp()
@@ -387,13 +611,6 @@ def find_item_matches(cur, item, prefix, debug=False):
                 dist > 100):
             continue
 
-        sql = (f'select ST_AsText(ST_Transform(way, 4326)) '
-               f'from {prefix}_{src_type} '
-               f'where osm_id={src_id}')
-        cur.execute(sql)
-        row = cur.fetchone()
-        geom = row and row[0]
-
         candidate = {
             'osm_type': osm_type,
             'osm_id': osm_id,
@@ -403,7 +620,7 @@ def find_item_matches(cur, item, prefix, debug=False):
             # 'match': match.match_type.name,
             'planet_table': src_type,
             'src_id': src_id,
-            'geom': geom,
+            'geom': None,  # loaded by add_candidate_geoms
             'identifier_match': identifier_match,
             'address_match': address_match,
             'name_match': name_match,
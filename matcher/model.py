@@ -1,6 +1,6 @@
 # coding: utf-8
 from flask import g, has_app_context
-from sqlalchemy import func
+from sqlalchemy import func, text
 from sqlalchemy.schema import ForeignKeyConstraint, ForeignKey, Column
 from sqlalchemy.types import BigInteger, Float, Integer, String, Boolean, DateTime, Text
 from sqlalchemy.ext.declarative import declarative_base
@@ -31,6 +31,34 @@ osm_type_enum = postgresql.ENUM('node', 'way', 'relation',
 disused_prefix_key = {'amenity', 'railway', 'leisure', 'tourism',
                       'man_made', 'shop', 'building'}
 
+identifier_properties = [
+    ('P238', ['iata'], 'IATA airport code'),
+    ('P239', ['icao'], 'ICAO airport code'),
+    ('P240', ['faa', 'ref'], 'FAA airport code'),
+    # ('P281', ['addr:postcode', 'postal_code'], 'postal code'),
+    ('P296', ['ref', 'ref:train', 'railway:ref'], 'station code'),
+    ('P300', ['ISO3166-2'], 'ISO 3166-2 code'),
+    ('P649', ['ref:nrhp'], 'NRHP reference number'),
+    ('P722', ['uic_ref'], 'UIC station code'),
+    ('P836', ['ref:gss'], 'UK Government Statistical Service code'),
+    ('P856', ['website', 'contact:website', 'url'], 'website'),
+    ('P882', ['nist:fips_code'], 'FIPS 6-4 (US counties)'),
+    ('P883', ['state_code', 'ref', 'nist:fips_code'], 'FIPS 5-2 (code for US states)'),
+    # A UIC id can be a IBNR, but not every IBNR is an UIC id
+    ('P954', ['uic_ref'], 'IBNR ID'),
+    ('P1216', ['HE_ref'], 'National Heritage List for England number'),
+    ('P2253', ['ref:edubase'], 'EDUBase URN'),
+    ('P2815', ['esr:user', 'ref', 'ref:train'], 'ESR station code'),
+    ('P3562', ['seamark:light:reference'], 'Admiralty number'),
+    ('P4755', ['ref', 'ref:train'], 'UK railway station code'),
+    ('P4803', ['ref', 'ref:train'], 'Amtrak station code'),
+]
+
+# claims kept by wikidata.project_entity, other claims are dropped
+entity_claims = ({'P17', 'P18', 'P31', 'P131', 'P373', 'P625', 'P649',
+                  'P1448', 'P1705'} |
+                 {pid for pid, osm_keys, label in identifier_properties})
+
 class User(Base, UserMixin):
     __tablename__ = 'user'
     id = Column(Integer, primary_key=True)
@@ -57,10 +85,15 @@ class User(Base, UserMixin):
 class IsA(Base):
     __tablename__ = 'isa'
     item_id = Column(Integer, primary_key=True, autoincrement=False)
-    entity = Column(postgresql.JSON)
+    entity = Column(postgresql.JSONB)
+    lastrevid = Column(Integer)
     qid = column_property('Q' + cast(item_id, String))
     label = Column(String)
 
+    def set_entity(self, entity):
+        self.entity = wikidata.project_entity(entity)
+        self.lastrevid = entity.get('lastrevid')
+
     def url(self):
         return f'https://www.wikidata.org/wiki/Q{self.item_id}'
 
@@ -113,7 +146,8 @@ class Item(Base):
     item_id = Column(Integer, primary_key=True, autoincrement=False)
     location = Column(Geography('POINT', spatial_index=True), nullable=False)
     enwiki = Column(String, index=True)
-    entity = Column(postgresql.JSON)
+    entity = Column(postgresql.JSONB)  # see wikidata.project_entity
+    lastrevid = Column(Integer)  # revision of entity, to skip unchanged
     categories = Column(postgresql.ARRAY(String))
     old_tags = Column(postgresql.ARRAY(String))
     qid = column_property('Q' + cast(item_id, String))
@@ -136,6 +170,10 @@ class Item(Base):
                                  backref='item')
     extracts = association_proxy('wiki_extracts', 'extract')
 
+    def set_entity(self, entity):
+        self.entity = wikidata.project_entity(entity, entity_claims)
+        self.lastrevid = entity.get('lastrevid')
+
     @property
     def extract(self):
         return self.extracts.get('enwiki')
@@ -282,31 +320,8 @@ class Item(Base):
         if not self.entity:
             return {}
 
-        property_map = [
-            ('P238', ['iata'], 'IATA airport code'),
-            ('P239', ['icao'], 'ICAO airport code'),
-            ('P240', ['faa', 'ref'], 'FAA airport code'),
-            # ('P281', ['addr:postcode', 'postal_code'], 'postal code'),
-            ('P296', ['ref', 'ref:train', 'railway:ref'], 'station code'),
-            ('P300', ['ISO3166-2'], 'ISO 3166-2 code'),
-            ('P649', ['ref:nrhp'], 'NRHP reference number'),
-            ('P722', ['uic_ref'], 'UIC station code'),
-            ('P836', ['ref:gss'], 'UK Government Statistical Service code'),
-            ('P856', ['website', 'contact:website', 'url'], 'website'),
-            ('P882', ['nist:fips_code'], 'FIPS 6-4 (US counties)'),
-            ('P883', ['state_code', 'ref', 'nist:fips_code'], 'FIPS 5-2 (code for US states)'),
-            # A UIC id can be a IBNR, but not every IBNR is an UIC id
-            ('P954', ['uic_ref'], 'IBNR ID'),
-            ('P1216', ['HE_ref'], 'National Heritage List for England number'),
-            ('P2253', ['ref:edubase'], 'EDUBase URN'),
-            ('P2815', ['esr:user', 'ref', 'ref:train'], 'ESR station code'),
-            ('P3562', ['seamark:light:reference'], 'Admiralty number'),
-            ('P4755', ['ref', 'ref:train'], 'UK railway station code'),
-            ('P4803', ['ref', 'ref:train'], 'Amtrak station code'),
-        ]
-
         tags = defaultdict(list)
-        for claim, osm_keys, label in property_map:
+        for claim, osm_keys, label in identifier_properties:
             values = [i['mainsnak']['datavalue']['value']
                       for i in self.entity['claims'].get(claim, [])
                       if 'datavalue' in i['mainsnak']]
@@ -541,6 +556,7 @@ class PlaceItem(Base):
     osm_id = Column(BigInteger, primary_key=True)
     place_id = Column(BigInteger)  # unused, replaced by osm_type & osm_id
     done = Column(Boolean)
+    fingerprint = Column(String)  # see matcher.item_fingerprint
 
     __table_args__ = (
         ForeignKeyConstraint(
@@ -855,6 +871,68 @@ def get_bad(items):
                 .filter(BadMatch.item_id.in_([i.item_id for i in items])))
     return {item_id for item_id, in q}
 
+candidate_columns = ['name', 'dist', 'tags', 'planet_table', 'src_id', 'geom',
+                     'identifier_match', 'address_match', 'name_match']
+
+# candidates for the given items that aren't in the keep list, candidates
+# that have been saved to OSM are kept because of the changeset_edit foreign key
+stale_candidate_where = '''
+c.item_id = any(cast(:item_ids as integer[]))
+and (c.item_id, c.osm_type::text, c.osm_id) not in (
+    select * from unnest(cast(:keep_item_id as integer[]),
+                         cast(:keep_osm_type as text[]),
+                         cast(:keep_osm_id as bigint[])))
+and not exists (
+    select 1 from changeset_edit e
+    where (e.item_id, e.osm_type, e.osm_id) = (c.item_id, c.osm_type, c.osm_id))
+'''
+
+def delete_stale_candidates(found):
+    ''' Remove candidates that no longer match.
+
+    found maps item_id to the list of candidate dicts for that item. '''
+    if not found:
+        return
+    keep = [(item_id, c['osm_type'], c['osm_id'])
+            for item_id, candidates in found.items()
+            for c in candidates]
+    params = {
+        'item_ids': list(found.keys()),
+        'keep_item_id': [item_id for item_id, osm_type, osm_id in keep],
+        'keep_osm_type': [osm_type for item_id, osm_type, osm_id in keep],
+        'keep_osm_id': [osm_id for item_id, osm_type, osm_id in keep],
+    }
+
+    bad_match_sql = ('delete from bad_match ' +
+                     'where (item_id, osm_type, osm_id) in (' +
+                     'select c.item_id, c.osm_type, c.osm_id ' +
+                     'from item_candidate c where ' + stale_candidate_where + ')')
+    candidate_sql = 'delete from item_candidate c where ' + stale_candidate_where
+
+    session.execute(text(bad_match_sql), params)
+    session.execute(text(candidate_sql), params)
+
+def upsert_candidates(found):
+    ''' Insert or update candidates with a single statement.
+
+    found maps item_id to the list of candidate dicts for that item. '''
+    rows = {}
+    for item_id, candidates in found.items():
+        for c in candidates:
+            key = (item_id, c['osm_id'], c['osm_type'])
+            rows[key] = {'item_id': item_id,
+                         'osm_id': c['osm_id'],
+                         'osm_type': c['osm_type'],
+                         **{col: c.get(col) for col in candidate_columns}}
+    if not rows:
+        return
+
+    insert = postgresql.insert(ItemCandidate.__table__).values(list(rows.values()))
+    stmt = insert.on_conflict_do_update(
+        index_elements=['item_id', 'osm_id', 'osm_type'],
+        set_={col: insert.excluded[col] for col in candidate_columns})
+    session.execute(stmt)
+
 class Language(Base):
     __tablename__ = 'language'
     item_id = Column(Integer, primary_key=True, autoincrement=False)
@@ -1,27 +1,67 @@
+'''Netstrings over a socket, used between the websocket and the task queue.
+
+A message is sent as <length>:<payload>, with the length in bytes.
+'''
+
+recv_size = 64 * 1024
+max_length = 16 * 1024 * 1024  # chunk lists for big places are a few MB
+
+class NetstringError(Exception):
+    pass
+
+def encode(to_send):
+    data = to_send.encode('utf-8')
+    return b'%d:%s,' % (len(data), data)
+
 def write(sock, to_send):
-    sock.sendall(b'%d' % len(to_send))
-    sock.sendall(b':')
-    sock.sendall(to_send.encode('utf-8'))
-    sock.sendall(b',')
+    sock.sendall(encode(to_send))
+
+def write_many(sock, messages):
+    ''' Send several messages with a single sendall. '''
+    sock.sendall(b''.join(encode(msg) for msg in messages))
+
+class Reader:
+    ''' Read netstrings from a socket, buffering what has been received. '''
+    def __init__(self, sock, max_length=max_length):
+        self.sock = sock
+        self.max_length = max_length
+        self.buf = bytearray()
+
+    def fill(self):
+        data = self.sock.recv(recv_size)
+        self.buf += data
+        return bool(data)
+
+    def read(self):
+        ''' Next message, or None if the socket closed between messages. '''
+        colon = self.buf.find(b':')
+        while colon == -1:
+            if len(self.buf) > len(str(self.max_length)):
+                raise NetstringError('length prefix too long')
+            if not self.fill():
+                if self.buf:
+                    raise NetstringError('socket closed in length prefix')
+                return
+            colon = self.buf.find(b':')
+
+        prefix = bytes(self.buf[:colon])
+        if not prefix.isdigit():
+            raise NetstringError('bad length prefix: {!r}'.format(prefix))
+        byte_len = int(prefix)
+        if byte_len > self.max_length:
+            raise NetstringError('message too long: {:,d} bytes'.format(byte_len))
+
+        end = colon + 1 + byte_len
+        while len(self.buf) <= end:
+            if not self.fill():
+                raise NetstringError('socket closed in message')
+        if self.buf[end] != ord(','):
+            raise NetstringError('message not terminated by comma')
+
+        msg = bytes(self.buf[colon + 1:end]).decode('utf-8')
+        del self.buf[:end + 1]
+        return msg
 
 def read(sock):
-    char = sock.recv(1)
-    if char == b'':
-        return
-    buf = b''
-    while char != b':':
-        if not char.isdigit():
-            print('char:', repr(char))
-        assert char.isdigit()
-        buf += char
-        char = sock.recv(1)
-    byte_len = int(buf.decode('ASCII'))
-    buf = b''
-    while len(buf) < byte_len:
-        buf += sock.recv(byte_len - len(buf))
-    assert len(buf) == byte_len
-    char = sock.recv(1)
-    while char == b'':
-        char = sock.recv(1)
-    assert char == b','
-    return buf.decode('utf-8')
+    ''' Read a single reply, only for sockets that are then closed. '''
+    return Reader(sock).read()
@@ -1,17 +1,34 @@
 #!/usr/bin/python3
 import re
 import requests
+import os
 import os.path
+import gzip
+import bz2
+import subprocess
+import shutil
 import json
 import simplejson
 from flask import current_app
 from time import sleep
 from . import user_agent_headers, mail
+from . import disk_cache
+from .disk_cache import hash_key
 from collections import defaultdict
 
 re_slot_available = re.compile('^Slot available after: ([^,]+), in (-?\d+) seconds?\.$')
 re_available_now = re.compile('^\d+ slots available now.$')
 
+download_chunk_size = 256 * 1024
+error_check_size = 2000  # how much of each end of a response to check for errors
+error_markers = [b'<remark> runtime error', b'<title>504 Gateway']
+split_markers = [b'Query run out of memory', b'Query timed out', b'<title>504 Gateway']
+max_split_depth = 3  # a failed query is split into at most 4 ** 3 pieces
+re_timeout_setting = re.compile(r'\[timeout:\d+\]')
+default_cache_bytes = 10 * 1024 ** 3
+default_cache_ttl = 24 * 60 * 60  # seconds
+re_bbox_setting = re.compile(r'\[bbox:(-?[0-9.]+),(-?[0-9.]+),(-?[0-9.]+),(-?[0-9.]+)\]')
+
 name_only_tag = {'area=yes', 'type=tunnel', 'leisure=park', 'leisure=garden',
         'site=aerodome', 'amenity=hospital', 'boundary', 'amenity=pub',
         'amenity=cinema', 'ruins', 'retail=retail_park',
@@ -20,8 +37,8 @@ name_only_tag = {'area=yes', 'type=tunnel', 'leisure=park', 'leisure=garden',
 name_only_key = ['place', 'landuse', 'admin_level', 'water', 'man_made',
         'railway', 'aeroway', 'bridge', 'natural']
 
-def endpoint():
-    return current_app.config['OVERPASS_URL'] + '/api/interpreter'
+def endpoint(url=None):
+    return (url or current_app.config['OVERPASS_URL']) + '/api/interpreter'
 
 class RateLimited(Exception):
     pass
@@ -33,8 +50,8 @@ class OverpassError(Exception):
     def __init__(self, r):
         self.r = r
 
-def run_query(oql, error_on_rate_limit=True):
-    r = requests.post(endpoint(), data=oql, headers=user_agent_headers())
+def run_query(oql, error_on_rate_limit=True, url=None):
+    r = requests.post(endpoint(url), data=oql, headers=user_agent_headers())
 
     if (error_on_rate_limit and
             r.status_code == 429 and
@@ -203,8 +220,8 @@ def parse_status(r):
         'running': len(lines) - (i + 1)
     }
 
-def status_url():
-    return current_app.config['OVERPASS_URL'] + '/api/status'
+def status_url(url=None):
+    return (url or current_app.config['OVERPASS_URL']) + '/api/status'
 
 def get_status(url=None):
     r = requests.get(url or status_url(), timeout=10)
@@ -220,22 +237,116 @@ def wait_for_slot(status=None, url=None):
         print('waiting {} seconds'.format(slots[0]))
         sleep(slots[0] + 1)
 
-def item_filename(wikidata_id, radius):
-    assert wikidata_id[0] == 'Q'
-    overpass_dir = current_app.config['OVERPASS_DIR']
-    return os.path.join(overpass_dir, '{}_{}.json'.format(wikidata_id, radius))
+def body_failed(head, tail):
+    ''' Overpass returned an error rather than OSM data. '''
+    return any(marker in head or marker in tail for marker in error_markers)
+
+def open_for_write(filename, target):
+    ''' Compress if the target ends .gz or .bz2, osmium and osm2pgsql read both. '''
+    if target.endswith('.gz'):
+        return gzip.open(filename, 'wb')
+    if target.endswith('.bz2'):
+        return bz2.open(filename, 'wb')
+    return open(filename, 'wb')
+
+def stream_to_file(r, filename):
+    ''' Write a streamed response to a temp file next to filename.
+
+    Only the first and last few KB of the body are kept in memory, for
+    error checks. Returns the temp filename, head, tail and size. '''
+    tmp = '{}.{}.part'.format(filename, os.getpid())
+    head = tail = b''
+    size = 0
+    with open_for_write(tmp, filename) as out:
+        for data in r.iter_content(download_chunk_size):
+            if len(head) < error_check_size:
+                head += data[:error_check_size - len(head)]
+            tail = (tail + data)[-error_check_size:]
+            size += len(data)
+            out.write(data)
+    return tmp, head, tail, size
+
+def normalize_oql(oql):
+    ''' Same text for queries that only differ in layout or timeout. '''
+    oql = re_timeout_setting.sub('', oql)
+    return '\n'.join(' '.join(line.split()) for line in oql.splitlines()
+                     if line.strip())
+
+def cache_key(oql, variant=''):
+    return hash_key(normalize_oql(oql) + '\n' + variant)
+
+def get_cache():
+    ''' Cache of Overpass responses, None outside the app or without CACHE_DIR. '''
+    return disk_cache.app_cache('overpass', default_cache_bytes, default_cache_ttl)
+
+def download_key(oql, filename):
+    return cache_key(oql, variant=os.path.splitext(filename)[1])  # extension sets compression
+
+def forget(oql, filename, depth=0):
+    ''' Drop cached copies of a download and of the parts it could be split
+    into, so the next download goes to Overpass. '''
+    cache = get_cache()
+    if not cache:
+        return
+    cache.delete(download_key(oql, filename))
+    if depth < max_split_depth and oql_bbox(oql):
+        for part_oql in split_oql(oql):
+            forget(part_oql, filename, depth=depth + 1)
+
+def copy_from_cache(cached, filename):
+    tmp = '{}.{}.part'.format(filename, os.getpid())
+    try:
+        os.link(cached, tmp)
+    except OSError:
+        shutil.copyfile(cached, tmp)
+    os.replace(tmp, filename)
+
+def download(oql, filename, url=None):
+    ''' Run a query, streaming the OSM data to filename.
+
+    A fresh copy in the cache is used instead of Overpass. A stale copy is
+    only used if Overpass fails. Returns the response, or None from the cache.
+    '''
+    cache = get_cache()
+    key = download_key(oql, filename)
+    hit = cache.lookup(key) if cache else None
+    if hit and hit.fresh:
+        copy_from_cache(hit.filename, filename)
+        return
+
+    try:
+        r = download_uncached(oql, filename, url=url)
+    except (OverpassError, requests.exceptions.RequestException):
+        if not hit:
+            raise
+        print('overpass failed, using stale cache entry')
+        copy_from_cache(hit.filename, filename)
+        return
+
+    if cache:
+        cache.store_file(key, filename)
+    return r
+
+def download_uncached(oql, filename, url=None):
+    ''' Run a query, streaming the OSM data to filename.
 
-def existing_item_filename(wikidata_id):
-    assert wikidata_id[0] == 'Q'
-    overpass_dir = current_app.config['OVERPASS_DIR']
-    return os.path.join(overpass_dir, '{}_existing.json'.format(wikidata_id))
+    The file is replaced by a rename once the download is complete. Raises
+    OverpassError if the response is an error, the content of the response is
+    set to the start and end of the body so it can be reported. '''
+    r = requests.post(endpoint(url), data=oql, headers=user_agent_headers(),
+                      stream=True)
+    with r:
+        tmp, head, tail, size = stream_to_file(r, filename)
 
-def item_query(oql, wikidata_id, radius=1000, refresh=False):
-    filename = item_filename(wikidata_id, radius)
+    if r.status_code == 200 and not body_failed(head, tail):
+        os.replace(tmp, filename)
+        return r
 
-    if not refresh and os.path.exists(filename):
-        return json.load(open(filename))['elements']
+    os.remove(tmp)
+    r._content = head if size <= error_check_size else head + b'\n...\n' + tail
+    raise OverpassError(r)
 
+def item_json(oql):
     r = run_query(oql)
 
     if len(r.content) < 2000 and b'<title>504 Gateway' in r.content:
@@ -243,40 +354,43 @@ def item_query(oql, wikidata_id, radius=1000, refresh=False):
         raise Timeout
 
     try:
-        data = r.json()
+        return r.json()
     except simplejson.scanner.JSONDecodeError:
         mail.error_mail('item overpass query error', oql, r)
         raise
 
-    json.dump(data, open(filename, 'w'))
-    return data['elements']
+def cached_json(oql, refresh=False):
+    ''' JSON reply to a query, from the cache while it is fresh. A stale entry
+    is revalidated by running the query again, and used if Overpass fails. '''
+    cache = get_cache()
+    key = cache_key(oql)
+    hit = cache.lookup(key) if cache and not refresh else None
+    if hit and hit.fresh:
+        return json.load(open(hit.filename))
 
-def get_existing(wikidata_id, refresh=False):
-    filename = existing_item_filename(wikidata_id)
+    try:
+        data = item_json(oql)
+    except (RateLimited, Timeout, requests.exceptions.RequestException):
+        if not hit:
+            raise
+        print('overpass failed, using stale cache entry')
+        return json.load(open(hit.filename))
 
-    if not refresh and os.path.exists(filename):
-        return json.load(open(filename))['elements']
+    if cache:
+        cache.store(key, json.dumps(data).encode('utf-8'))
+    return data
+
+def item_query(oql, wikidata_id, radius=1000, refresh=False):
+    return cached_json(oql, refresh=refresh)['elements']
 
+def get_existing(wikidata_id, refresh=False):
     oql = '''
 [timeout:300][out:json];
 (node[wikidata={qid}]; way[wikidata={qid}]; rel[wikidata={qid}];);
 out qt center tags;
 '''.format(qid=wikidata_id)
 
-    r = run_query(oql)
-
-    if len(r.content) < 2000 and b'<title>504 Gateway' in r.content:
-        mail.error_mail('item query: overpass 504 gateway timeout', oql, r)
-        raise Timeout
-
-    try:
-        data = r.json()
-    except simplejson.scanner.JSONDecodeError:
-        mail.error_mail('item overpass query error', oql, r)
-        raise
-
-    json.dump(data, open(filename, 'w'))
-    return data['elements']
+    return cached_json(oql, refresh=refresh)['elements']
 
 def get_tags(elements):
     union = {'{}({});\n'.format({'relation': 'rel'}.get(i.osm_type, i.osm_type), i.osm_id)
@@ -290,18 +404,84 @@ out qt tags;
 
     return get_elements(oql)
 
-def run_query_persistent(oql, attempts=3, via_web=True):
+def oql_bbox(oql):
+    ''' The (south, north, west, east) bbox setting of a query. '''
+    m = re_bbox_setting.search(oql)
+    if m:
+        south, west, north, east = map(float, m.groups())
+        return (south, north, west, east)
+
+def split_oql(oql):
+    ''' The same query for each quarter of its bbox. '''
+    south, north, west, east = oql_bbox(oql)
+    mid_lat, mid_lon = (south + north) / 2, (west + east) / 2
+    quarters = [(south, mid_lat, west, mid_lon), (south, mid_lat, mid_lon, east),
+                (mid_lat, north, west, mid_lon), (mid_lat, north, mid_lon, east)]
+    return [re_bbox_setting.sub('[bbox:{:f},{:f},{:f},{:f}]'.format(s, w, n, e), oql)
+            for s, n, w, e in quarters]
+
+def needs_split(r):
+    ''' Overpass ran out of memory or time, a smaller area might work. '''
+    return r.status_code == 504 or any(marker in r.content for marker in split_markers)
+
+def part_filename(filename, label):
+    ''' Filename with label inserted before the extension. '''
+    dirname, basename = os.path.split(filename)
+    stem, _, ext = basename.partition('.')
+    return os.path.join(dirname, f'{stem}.{label}.{ext}')
+
+def merge_files(files, filename):
+    tmp = part_filename(filename, 'merge')
+    subprocess.run(['osmium', 'merge', '--overwrite'] + files + ['-o', tmp],
+                   check=True)
+    os.replace(tmp, filename)
+
+def download_split(oql, filename, url=None, on_split=None, depth=0):
+    ''' Download, splitting the bbox into quarters if Overpass runs out of
+    memory or time. The pieces are merged into filename.
+
+    on_split is called with the bbox of each query that had to be split.
+    Pieces already on disk from an earlier attempt are kept. '''
+    try:
+        download(oql, filename, url=url)
+        return filename
+    except OverpassError as e:
+        if (depth >= max_split_depth or not needs_split(e.r) or
+                not oql_bbox(oql)):
+            raise
+
+    print('splitting query into quarters:', oql_bbox(oql))
+    if on_split:
+        on_split(oql_bbox(oql))
+    parts = []
+    for num, part_oql in enumerate(split_oql(oql)):
+        part = part_filename(filename, f'part{depth}_{num}')
+        if not os.path.exists(part):
+            download_split(part_oql, part, url=url, on_split=on_split,
+                           depth=depth + 1)
+        parts.append(part)
+
+    merge_files(parts, filename)
+    for part in parts:
+        os.remove(part)
+    return filename
+
+def download_persistent(oql, filename, attempts=3, via_web=True, on_split=None):
     for attempt in range(attempts):
         wait_for_slot()
         print('calling overpass')
-        r = run_query(oql, error_on_rate_limit=False)
-        if r is None:
+        try:
+            return download_split(oql, filename, on_split=on_split)
+        except OverpassError as e:
+            r = e.r
+
+        if r.status_code == 429:
             seconds = 30
             print('retrying, waiting {} seconds'.format(seconds))
             sleep(seconds)
             continue
-        if len(r.content) < 2000 and b'<remark> runtime error:' in r.content:
 
+        if b'<remark> runtime error:' in r.content:
             msg = 'runtime error'
             mail.error_mail(msg, oql, r, via_web=via_web)
             print(msg)
@@ -309,13 +489,9 @@ def run_query_persistent(oql, attempts=3, via_web=True):
                 return
             continue  # retry
 
-        if len(r.content) < 2000 and b'<title>504 Gateway' in r.content:
-            msg = 'overpass timeout'
-            mail.error_mail(msg, oql, r, via_web=via_web)
-            print(msg)
-            continue  # retry
-
-        return r
+        msg = 'overpass timeout' if b'<title>504 Gateway' in r.content else 'overpass error'
+        mail.error_mail(msg, oql, r, via_web=via_web)
+        print(msg)
 
 def items_as_xml(items):
     assert items
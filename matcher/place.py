@@ -1,26 +1,37 @@
-from flask import current_app, url_for, g, abort
-from .model import Base, Item, ItemCandidate, PlaceItem, ItemTag, Changeset, IsA, ItemIsA, osm_type_enum, get_bad
+from flask import Flask, current_app, url_for, g, abort
+from .model import Base, Item, ItemCandidate, PlaceItem, ItemTag, Changeset, IsA, ItemIsA, osm_type_enum, get_bad, delete_stale_candidates, upsert_candidates
 from sqlalchemy.types import BigInteger, Float, Integer, JSON, String, DateTime, Boolean
 from sqlalchemy import func, select, cast
 from sqlalchemy.schema import ForeignKeyConstraint, ForeignKey, Column, UniqueConstraint
-from sqlalchemy.orm import relationship, backref, column_property, object_session, deferred, load_only
+from sqlalchemy.orm import relationship, backref, column_property, object_session, deferred, load_only, undefer, contains_eager
 from sqlalchemy.orm.exc import MultipleResultsFound
 from sqlalchemy.sql.expression import true, false, or_
 from geoalchemy2 import Geography, Geometry
 from sqlalchemy.ext.hybrid import hybrid_property
-from .database import session, get_tables, now_utc
-from . import wikidata, matcher, wikipedia, overpass, utils, nominatim, default_change_comments
+from .database import session, get_tables, now_utc, init_db
+from . import wikidata, matcher, match, wikipedia, overpass, utils, nominatim, default_change_comments
 from collections import Counter
 from .overpass import oql_from_tag
 from time import time
 from collections import defaultdict
+from functools import partial
 
 import json
+import hashlib
+import multiprocessing
 import subprocess
 import os.path
+import math
 import re
 
-place_chunk_size = 32
+metres_per_degree = 111_320
+# most items and largest area in km² for a single request
+chunk_budget = {
+    'overpass': (500, 4096),
+    'wikidata': (2000, 5000),
+}
+max_chunk_depth = 6
+matcher_batch_size = 500
 degrees = '(-?[0-9.]+)'
 re_box = re.compile(f'^BOX\({degrees} {degrees},{degrees} {degrees}\)$')
 
@@ -65,6 +76,63 @@ def bbox_chunk(bbox, n):
             chunks.append(chunk)
     return chunks
 
+def search_bbox(lat, lon, radius):
+    ''' Bounding box in degrees around a point for a radius in metres. '''
+    dlat = radius / metres_per_degree
+    dlon = radius / (metres_per_degree * max(math.cos(math.radians(lat)), 0.01))
+    return (lat - dlat, lat + dlat, lon - dlon, lon + dlon)
+
+def bbox_overlap(a, b, edges=True):
+    ''' Do two (south, north, west, east) boxes overlap, edges=False means
+    boxes that only touch don't count. '''
+    if not edges:
+        return a[0] < b[1] and b[0] < a[1] and a[2] < b[3] and b[2] < a[3]
+    return a[0] <= b[1] and b[0] <= a[1] and a[2] <= b[3] and b[2] <= a[3]
+
+def bbox_area(bbox):
+    ''' Approximate area of a bbox in km². '''
+    south, north, west, east = bbox
+    mid_lat = math.radians((south + north) / 2)
+    km = metres_per_degree / 1000
+    return (north - south) * km * (east - west) * km * math.cos(mid_lat)
+
+def quadtree_chunks(bbox, points, too_big, depth=0):
+    ''' Split a bbox into quarters until each piece is small enough.
+
+    too_big is called with a bbox and the number of points inside it. '''
+    south, north, west, east = bbox
+    inside = [(lat, lon) for lat, lon in points
+              if south <= lat <= north and west <= lon <= east]
+    if depth >= max_chunk_depth or not too_big(bbox, len(inside)):
+        yield bbox
+        return
+    for quarter in bbox_chunk(bbox, 2):
+        yield from quadtree_chunks(quarter, inside, too_big, depth + 1)
+
+def match_worker_init(config):
+    ''' Set up a matcher worker process with its own database connection. '''
+    app = Flask('match_worker')
+    app.config.update(config)
+    app.app_context().push()
+    init_db(config['DB_URL'])
+
+def match_worker(item_ids, prefix):
+    ''' Run the candidate search for a batch of items in a worker process.
+
+    Returns a dict mapping item_id to a list of candidate dicts. '''
+    q = Item.query.filter(Item.item_id.in_(item_ids)).options(undefer(Item.ewkt))
+    by_id = {item.item_id: item for item in q}
+    search = [by_id[item_id] for item_id in item_ids
+              if item_id in by_id and not by_id[item_id].skip_item_during_match()]
+
+    conn = session.bind.raw_connection()
+    try:
+        found = matcher.find_batch_item_matches(conn.cursor(), search, prefix)
+        return {item.item_id: candidates for item, candidates in found}
+    finally:
+        conn.close()
+        session.remove()
+
 def envelope(bbox):
     # note: different order for coordinates, xmin first, not ymin
     ymin, ymax, xmin, xmax = bbox
@@ -101,6 +169,7 @@ class Place(Base):
     item_types_retrieved = Column(Boolean, default=False)
     index_hide = Column(Boolean, default=False)
     overpass_is_in = deferred(Column(JSON))
+    failed_chunks = deferred(Column(JSON))  # bboxes that hit timeouts, by source
 
     area = column_property(func.ST_Area(geom))
     geojson = column_property(func.ST_AsGeoJSON(geom, 4), deferred=True)
@@ -297,28 +366,9 @@ class Place(Base):
         if bbox is None:
             bbox = self.bbox
 
-        q = wikidata.get_enwiki_query(*bbox)
-        rows = wikidata.run_query(q)
-
-        items = wikidata.parse_enwiki_query(rows)
-
-        try:  # add items with the coordinates in the HQ field
-            q = wikidata.get_enwiki_hq_query(*bbox)
-            items.update(wikidata.parse_enwiki_query(rows))
-        except wikidata.QueryError:
-            pass  # HQ query timeout isn't fatal
-
-        q = wikidata.get_item_tag_query(*bbox)
-        rows = wikidata.run_query(q)
-        wikidata.parse_item_tag_query(rows, items)
-
-        try:  # add items with the coordinates in the HQ field
-            q = wikidata.get_hq_item_tag_query(*bbox)
-            rows = wikidata.run_query(q)
-            wikidata.parse_item_tag_query(rows, items)
-        except wikidata.QueryError:
-            pass  # HQ query timeout isn't fatal
+        return self.covered_items(wikidata.bbox_items(bbox))
 
+    def covered_items(self, items):
         # would be nice to include OSM chunk information with each
         # item not doing it at this point because it means lots
         # of queries easier once the items are loaded into the database
@@ -343,6 +393,11 @@ class Place(Base):
     def prefix(self):
         return f'osm_{self.place_id}'
 
+    @property
+    def osm_digest_table(self):
+        ''' Digest of the OSM data used by the last matcher run. '''
+        return self.prefix + '_digest'
+
     @property
     def identifier(self):
         return f'{self.osm_type}/{self.osm_id}'
@@ -350,18 +405,27 @@ class Place(Base):
     @property
     def overpass_filename(self):
         overpass_dir = current_app.config['OVERPASS_DIR']
-        return os.path.join(overpass_dir, '{}.xml'.format(self.place_id))
+        compression = current_app.config.get('OVERPASS_COMPRESSION')
+        ext = 'osm.' + compression if compression else 'xml'
+        return os.path.join(overpass_dir, '{}.{}'.format(self.place_id, ext))
 
     def is_overpass_filename(self, f):
         ''' Does the overpass filename belongs to this place. '''
         place_id = str(self.place_id)
-        return f == place_id + '.xml' or f.startswith(place_id + '_')
+        return (f == os.path.basename(self.overpass_filename) or
+                f == place_id + '.xml' or f.startswith(place_id + '_'))
 
     def delete_overpass(self):
+        ''' Remove the OSM data, including cached copies, for a full refresh. '''
         for f in os.scandir(current_app.config['OVERPASS_DIR']):
             if self.is_overpass_filename(f.name):
                 os.remove(f.path)
 
+        overpass.forget(self.get_oql(), self.overpass_filename)
+        for chunk in self.get_chunks():
+            if chunk['oql']:
+                overpass.forget(chunk['oql'], chunk['filename'])
+
     def clean_up(self):
         place_id = self.place_id
 
@@ -441,10 +505,15 @@ class Place(Base):
     def items_with_instanceof(self):
         return [item for item in self.items if item.instanceof()]
 
-    def osm2pgsql_cmd(self, filename=None):
+    def osm2pgsql_cmd(self, filename=None, append=False, keep_slim=False):
+        ''' Command to load a file, keep_slim keeps the tables needed to
+        --append more files later. '''
         if filename is None:
             filename = self.overpass_filename
-        return ['osm2pgsql', '--create', '--drop', '--slim',
+        mode = ['--append'] if append else ['--create']
+        if not (append or keep_slim):
+            mode.append('--drop')
+        return ['osm2pgsql'] + mode + ['--slim',
                 '--hstore-all', '--hstore-add-index',
                 '--prefix', self.prefix,
                 '--cache', '1000',
@@ -479,6 +548,12 @@ class Place(Base):
             else:
                 return p.stderr.decode('utf-8')
 
+    def drop_slim_tables(self):
+        ''' Remove the osm2pgsql tables only needed for --append. '''
+        engine = session.bind
+        for t in ('nodes', 'ways', 'rels'):
+            engine.execute(f'drop table if exists {self.prefix}_{t}')
+
     def save_overpass(self, content):
         with open(self.overpass_filename, 'wb') as out:
             out.write(content)
@@ -701,7 +776,7 @@ class Place(Base):
                       .group_by(Item.item_id)
                       .subquery())
         q = (self.items.filter(Item.item_id == sub.c.item_id)
-                       .options(load_only(Item.qid)))
+                       .options(load_only(Item.qid, Item.lastrevid)))
 
         if debug:
             print('running wbgetentities query')
@@ -711,10 +786,11 @@ class Place(Base):
         if debug:
             print('{} items'.format(len(items)))
 
-        for qid, entity in wikidata.entity_iter(items.keys(), debug=debug):
+        known = {qid: item.lastrevid for qid, item in items.items()}
+        for qid, entity in wikidata.updated_entity_iter(known, debug=debug):
             if debug:
                 print(qid)
-            items[qid].entity = entity
+            items[qid].set_entity(entity)
 
     def languages_osm(self):
         lang_count = Counter()
@@ -787,6 +863,98 @@ class Place(Base):
 
         for place_item in place_items:
             place_item.done = False
+            place_item.fingerprint = None  # force the matcher to run again
+        session.commit()
+
+    def osm_digest_sql(self):
+        return ' union all '.join(
+            f"select '{obj_type}'::text as src_type, osm_id, "
+            f"md5(convert_to(tags::text, 'UTF8') || ST_AsEWKB(way)) as digest, "
+            f'ST_Envelope(way) as way '
+            f'from {self.prefix}_{obj_type}'
+            for obj_type in ('point', 'line', 'polygon'))
+
+    def save_osm_digest(self):
+        table = self.osm_digest_table
+        session.execute(f'drop table if exists {table}')
+        session.execute(f'create table {table} as {self.osm_digest_sql()}')
+
+    def items_near_changed_osm(self, items):
+        ''' IDs of items with OSM data that changed since the last matcher
+        run within their search radius.
+
+        Returns None when there is no digest from a previous run. '''
+        if self.osm_digest_table not in get_tables():
+            return
+
+        sql = f'''
+with changed as (
+    select coalesce(n.way, o.way) as way
+    from ({self.osm_digest_sql()}) n
+    full join {self.osm_digest_table} o using (src_type, osm_id)
+    where n.digest is distinct from o.digest
+), i as (
+    select item_id, ST_Transform(ST_GeomFromEWKT(ewkt), 3857) as point, max_dist
+    from unnest(cast(:item_id as integer[]),
+                cast(:ewkt as text[]),
+                cast(:max_dist as float8[])) as t(item_id, ewkt, max_dist)
+)
+select distinct i.item_id
+from i join changed on ST_DWithin(i.point, changed.way, i.max_dist)'''
+
+        params = {
+            'item_id': [item.item_id for item in items],
+            'ewkt': [item.ewkt for item in items],
+            'max_dist': [matcher.search_radius(item) for item in items],
+        }
+        return {item_id for item_id, in session.execute(sql, params)}
+
+    def mark_changed_items_not_done(self, check_osm=True):
+        ''' Only items with a new fingerprint or changed OSM data nearby
+        need to go through the matcher again.
+
+        With check_osm=False only fingerprints are compared, for use before the
+        new OSM data is loaded, see mark_items_near_changed_osm_not_done. '''
+        place_items = (PlaceItem.query
+                                .join(Item)
+                                .filter(Item.entity.isnot(None),
+                                        PlaceItem.place == self)
+                                .options(contains_eager(PlaceItem.item).undefer('ewkt'))
+                                .all())
+        if not place_items:
+            return
+        if check_osm:
+            near_change = self.items_near_changed_osm([place_item.item
+                                                       for place_item in place_items])
+        else:
+            near_change = set() if self.osm_digest_table in get_tables() else None
+
+        for place_item in place_items:
+            if place_item.fingerprint is None:
+                place_item.done = False
+                continue
+            place_item.done = (near_change is not None and
+                               place_item.item_id not in near_change and
+                               place_item.fingerprint == matcher.item_fingerprint(place_item.item))
+        session.commit()
+
+    def mark_items_near_changed_osm_not_done(self):
+        ''' Once all the OSM data is loaded: done items with OSM data nearby
+        that changed since the last matcher run. '''
+        place_items = (PlaceItem.query
+                                .join(Item)
+                                .filter(Item.entity.isnot(None),
+                                        PlaceItem.place == self,
+                                        PlaceItem.done == true())
+                                .options(contains_eager(PlaceItem.item).undefer('ewkt'))
+                                .all())
+        if not place_items:
+            return
+        near_change = self.items_near_changed_osm([place_item.item
+                                                   for place_item in place_items])
+        for place_item in place_items:
+            if near_change and place_item.item_id in near_change:
+                place_item.done = False
         session.commit()
 
     def matcher_query(self):
@@ -798,67 +966,124 @@ class Place(Base):
                                      PlaceItem.done != true()))
                          .order_by(PlaceItem.item_id))
 
-    def run_matcher(self, debug=False, progress=None):
-        if progress is None:
-            def progress(candidates, item):
-                pass
-        conn = session.bind.raw_connection()
-        cur = conn.cursor()
-
+    def run_matcher(self, debug=False, progress=None,
+                    batch_size=matcher_batch_size, workers=None, reset=True):
+        ''' Search for OSM candidates for every item that isn't done.
+
+        With more than one worker the candidate search runs in a process
+        pool, database writes and progress callbacks stay in this process.
+        reset=False skips mark_changed_items_not_done, for when the done flags
+        were already set before a pipelined load.
+        '''
+        if reset:
+            self.mark_changed_items_not_done()
         place_items = self.matcher_query()
         total = place_items.count()
         # too many items means something has gone wrong
         assert total < 60_000
-        for num, place_item in enumerate(place_items):
-            item = place_item.item
+        self.match_place_items(place_items, debug=debug, progress=progress,
+                               batch_size=batch_size, workers=workers)
 
-            if debug:
-                print('searching for', item.label())
-                print(item.tags)
+        expect = [self.prefix + '_' + t for t in ('line', 'point', 'polygon')]
+        tables = get_tables()
+        if all(t in tables for t in expect):
+            self.save_osm_digest()
 
-            if item.skip_item_during_match():
-                candidates = []
-            else:
-                t0 = time()
-                candidates = matcher.find_item_matches(cur, item, self.prefix, debug=debug)
-                seconds = time() - t0
-                if debug:
-                    print('find_item_matches took {:.1f}'.format(seconds))
-                    print('{}: {}'.format(len(candidates), item.label()))
+        self.state = 'ready'
+        self.item_count = self.items.count()
+        self.candidate_count = self.items_with_candidates_count()
+        session.commit()
 
-            progress(candidates, item)
+    def items_clear_of(self, pending):
+        ''' Items to match with a search area that misses every bbox in pending.
+
+        Used while chunks are still loading, the OSM data these items need is
+        already in the database. '''
+        location = cast(Item.location, Geometry)
+        q = (self.matcher_query()
+                 .options(contains_eager(PlaceItem.item))
+                 .add_columns(func.ST_Y(location), func.ST_X(location)))
+        return [place_item for place_item, lat, lon in q
+                if not any(bbox_overlap(search_bbox(lat, lon,
+                                                    matcher.search_radius(place_item.item)),
+                                        bbox)
+                           for bbox in pending)]
+
+    def match_place_items(self, place_items, debug=False, progress=None,
+                          batch_size=matcher_batch_size, workers=None):
+        if progress is None:
+            def progress(candidates, item):
+                pass
+        if workers is None:
+            workers = current_app.config.get('MATCHER_WORKERS', 1)
 
-            # if this is a refresh we remove candidates that no longer match
-            as_set = {(i['osm_type'], i['osm_id']) for i in candidates}
-            for c in item.candidates[:]:
-                if c.edits.count():
-                    continue  # foreign keys mean we can't remove saved candidates
-                if (c.osm_type, c.osm_id) not in as_set:
-                    c.bad_matches.delete()
-                    session.delete(c)
+        batches = list(utils.chunk(place_items, batch_size))
 
-            if not candidates:
-                continue
+        if workers > 1:
+            found_iter = self.parallel_matches(batches, workers)
+        else:
+            found_iter = self.serial_matches(batches, debug=debug)
 
-            for i in candidates:
-                c = ItemCandidate.query.get((item.item_id, i['osm_id'], i['osm_type']))
-                if c:
-                    c.update(i)
-                else:
-                    c = ItemCandidate(**i, item=item)
-                    session.add(c)
+        for batch, found in zip(batches, found_iter):
+            self.save_batch_candidates(batch, found, progress, debug=debug)
+            session.commit()
 
-            place_item.done = True
+        if debug:
+            for name, info in match.name_cache_info().items():
+                print(f'{name}: {info.hits:,d} hits, {info.misses:,d} misses')
+
+    def serial_matches(self, batches, debug=False):
+        conn = session.bind.raw_connection()
+        cur = conn.cursor()
+        try:
+            for batch in batches:
+                search = [place_item.item for place_item in batch
+                          if not place_item.item.skip_item_during_match()]
+                t0 = time()
+                found = matcher.find_batch_item_matches(cur, search, self.prefix,
+                                                        debug=debug)
+                found = {item.item_id: candidates for item, candidates in found}
+                seconds = time() - t0
+                if debug:
+                    print('find_batch_item_matches took {:.1f}'.format(seconds))
+                yield found
+        finally:
+            conn.close()
+
+    def parallel_matches(self, batches, workers):
+        config = {key: current_app.config[key] for key in ('DB_URL', 'DATA_DIR')}
+        item_id_batches = [[place_item.item_id for place_item in batch]
+                           for batch in batches]
+        worker = partial(match_worker, prefix=self.prefix)
+
+        # spawn rather than fork, a forked worker would share the
+        # database connections of this process
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(workers,
+                      initializer=match_worker_init,
+                      initargs=(config,)) as pool:
+            # imap returns results in order, so the output matches serial mode
+            yield from pool.imap(worker, item_id_batches)
+
+    def save_batch_candidates(self, batch, found, progress, debug=False):
+        found = {place_item.item_id: found.get(place_item.item_id, [])
+                 for place_item in batch}
+        for place_item in batch:
+            item = place_item.item
+            candidates = found[item.item_id]
+            if debug:
+                print('{}: {}'.format(len(candidates), item.label()))
+                print(item.tags)
 
-            if num % 100 == 0:
-                session.commit()
+            progress(candidates, item)
 
-        self.state = 'ready'
-        self.item_count = self.items.count()
-        self.candidate_count = self.items_with_candidates_count()
-        session.commit()
+        # if this is a refresh we remove candidates that no longer match
+        delete_stale_candidates(found)
+        upsert_candidates(found)
 
-        conn.close()
+        for place_item in batch:
+            place_item.fingerprint = matcher.item_fingerprint(place_item.item)
+            place_item.done = True
 
     def load_isa(self):
         items = [item.qid for item in self.items_with_instanceof()]
@@ -891,7 +1116,7 @@ class Place(Base):
             item.isa = isa_objects
 
         for qid, entity in wikidata.entity_iter(download_isa):
-            isa_obj_map[qid].entity = entity
+            isa_obj_map[qid].set_entity(entity)
 
         session.commit()
 
@@ -941,9 +1166,9 @@ class Place(Base):
     def get_overpass(self):
         oql = self.get_oql()
         if self.area_in_sq_km < 800:
-            r = overpass.run_query_persistent(oql)
+            r = overpass.download_persistent(oql, self.overpass_filename,
+                                             on_split=self.record_overpass_split)
             assert r
-            self.save_overpass(r.content)
         else:
             self.chunk()
 
@@ -953,8 +1178,8 @@ class Place(Base):
 
         filter_list = matcher.filter_candidates_more(items, bad=get_bad(items))
         add_tags = []
-        for item, match in filter_list:
-            picked = match.get('candidate')
+        for item, picked_match in filter_list:
+            picked = picked_match.get('candidate')
             if not picked:
                 continue
             dist = picked.dist
@@ -1016,7 +1241,7 @@ class Place(Base):
         return chunks
 
     def get_chunks(self):
-        bbox_chunks = list(self.polygon_chunk(size=place_chunk_size))
+        bbox_chunks = self.plan_chunks('overpass')
 
         chunks = []
         need_self = True  # include self in first non-empty chunk
@@ -1027,15 +1252,21 @@ class Place(Base):
                 'num': num,
                 'oql': oql,
                 'filename': filename,
+                'bbox': chunk,
             })
             if need_self and oql:
                 need_self = False
         return chunks
 
     def chunk_filename(self, num, chunks):
+        ''' The bbox hash stops a file left by an older plan with the same
+        number of chunks being used for a different area. '''
         if len(chunks) == 1:
             return '{}.xml'.format(self.place_id)
-        return '{}_{:03d}_{:03d}.xml'.format(self.place_id, num, len(chunks))
+        bbox = '{:f},{:f},{:f},{:f}'.format(*chunks[num])
+        bbox_hash = hashlib.md5(bbox.encode('utf-8')).hexdigest()[:8]
+        return '{}_{:03d}_{:03d}_{}.xml'.format(self.place_id, num, len(chunks),
+                                                 bbox_hash)
 
     def chunk(self):
         chunk_size = utils.calc_chunk_size(self.area_in_sq_km)
@@ -1045,7 +1276,7 @@ class Place(Base):
 
         files = []
         for num, chunk in enumerate(chunks):
-            filename = self.chunk_filename(num, len(chunks))
+            filename = self.chunk_filename(num, chunks)
             # print(num, q.count(), len(tags), filename, list(tags))
             full = os.path.join('overpass', filename)
             files.append(full)
@@ -1053,11 +1284,11 @@ class Place(Base):
                 continue
             oql = self.oql_for_chunk(chunk, include_self=(num == 0))
 
-            r = overpass.run_query_persistent(oql)
+            r = overpass.download_persistent(oql, full,
+                                             on_split=self.record_overpass_split)
             if not r:
                 print(oql)
             assert r
-            open(full, 'wb').write(r.content)
 
         cmd = ['osmium', 'merge'] + files + ['-o', self.overpass_filename]
         print(' '.join(cmd))
@@ -1086,11 +1317,11 @@ class Place(Base):
         return oql
 
     def chunk_count(self):
-        return sum(1 for _ in self.polygon_chunk(size=place_chunk_size))
+        return len(self.plan_chunks('overpass'))
 
     def geojson_chunks(self):
         chunks = []
-        for chunk in self.polygon_chunk(size=place_chunk_size):
+        for chunk in self.plan_chunks('overpass'):
             clip = func.ST_Intersection(Place.geom, envelope(chunk))
 
             geojson = (session.query(func.ST_AsGeoJSON(clip, 4))
@@ -1100,11 +1331,59 @@ class Place(Base):
             chunks.append(geojson)
         return chunks
 
-    def wikidata_chunk_size(self):
-        area = self.area_in_sq_km
-        if area < 5000 and not self.wikidata_query_timeout:
-            return 1
-        return utils.calc_chunk_size(area, size=32)
+    def record_failed_chunk(self, source, bbox):
+        ''' Remember a bbox that timed out or ran out of memory, the next
+        chunk plan for this source splits it further. '''
+        failed = dict(self.failed_chunks or {})
+        if list(bbox) not in failed.get(source, []):
+            failed[source] = failed.get(source, []) + [list(bbox)]
+        self.failed_chunks = failed
+
+    def record_overpass_split(self, bbox):
+        self.record_failed_chunk('overpass', bbox)
+        session.commit()
+
+    def item_points(self):
+        location = cast(Item.location, Geometry)
+        return self.items.with_entities(func.ST_Y(location),
+                                        func.ST_X(location)).all()
+
+    def plan_chunks(self, source):
+        ''' Split the place into chunks for 'overpass' or 'wikidata'.
+
+        Cells are split by a quadtree until they are within the budget for
+        items and area, so dense areas get small chunks and sparse areas
+        big ones. Cells as big as one that failed before are split too. '''
+        max_items, max_area = chunk_budget[source]
+        polygons = list(self.polygon_bboxes())
+        failed = [tuple(bbox) for bbox in (self.failed_chunks or {}).get(source, [])]
+        if source == 'wikidata' and self.wikidata_query_timeout:
+            failed += polygons  # the unchunked query timed out
+        points = self.item_points()
+
+        def too_big(bbox, item_count):
+            area = bbox_area(bbox)
+            return (item_count > max_items or area > max_area or
+                    any(area >= bbox_area(f) * 0.99 and bbox_overlap(bbox, f, edges=False)
+                        for f in failed))
+
+        if not too_big(self.bbox, len(points)):
+            return [self.bbox]  # one request covers every polygon
+
+        chunks = []
+        for bbox in polygons:
+            chunks += quadtree_chunks(bbox, points, too_big)
+        return chunks
+
+    def polygon_bboxes(self):
+        ''' Bounding box of each polygon that makes up the place. '''
+        stmt = (session.query(func.ST_Dump(Place.geom.cast(Geometry())).label('x'))
+                       .filter_by(place_id=self.place_id)
+                       .subquery())
+
+        for box2d, in session.query(func.Box2D(stmt.c.x.geom)):
+            west, south, east, north = map(float, re_box.match(box2d).groups())
+            yield (south, north, west, east)
 
     def polygon_chunk(self, size=64):
         stmt = (session.query(func.ST_Dump(Place.geom.cast(Geometry())).label('x'))
@@ -30,6 +30,15 @@ def normalize_url(url):
         url = remove_start(url, start)
     return url.rstrip('/')
 
+def with_app_context(func):
+    ''' Wrap func to run inside the current app context, for worker threads. '''
+    app = current_app._get_current_object()
+
+    def wrapper(*args, **kwargs):
+        with app.app_context():
+            return func(*args, **kwargs)
+    return wrapper
+
 def cache_dir():
     return current_app.config['CACHE_DIR']
 
@@ -617,20 +617,23 @@ def refresh_place(osm_type, osm_id):
 
     refresh_type = request.form['type']
 
-    place.reset_all_items_to_not_done()
-
     if refresh_type == 'matcher':
+        # rerun the matcher for every item, the matcher code has changed
+        place.reset_all_items_to_not_done()
         place.state = 'osm2pgsql'
         database.session.commit()
         return redirect_to_matcher(place)
 
+    # a full refresh only rematches items with a changed fingerprint or OSM
+    # changes nearby, see Place.mark_changed_items_not_done
     assert refresh_type == 'full'
     place.delete_overpass()
     place.state = 'refresh'
 
     engine = database.session.bind
     for t in database.get_tables():
-        if not t.startswith(place.prefix):
+        # keep the digest, it is used to find changed OSM data
+        if not t.startswith(place.prefix) or t == place.osm_digest_table:
             continue
         engine.execute('drop table if exists {}'.format(t))
     engine.execute('commit')
@@ -1043,9 +1046,10 @@ def browse_page(item_id):
 
     for isa_qid, entity in wikidata.entity_iter(download_isa):
         if isa_map[isa_qid]:
-            isa_map[isa_qid].entity = entity
+            isa_map[isa_qid].set_entity(entity)
             continue
-        isa_obj = IsA(item_id=isa_qid[1:], entity=entity)
+        isa_obj = IsA(item_id=isa_qid[1:])
+        isa_obj.set_entity(entity)
         isa_map[isa_qid] = isa_obj
         database.session.add(isa_obj)
     if download_isa:
@@ -1255,11 +1259,11 @@ def item_page(wikidata_id):
 @app.route('/space')
 def space():
     overpass_dir = app.config['OVERPASS_DIR']
-    files = [{'file': f, 'size': f.stat().st_size} for f in os.scandir(overpass_dir) if '_' not in f.name and f.name.endswith('.xml')]
+    files = [{'file': f, 'size': f.stat().st_size} for f in os.scandir(overpass_dir) if '_' not in f.name and f.name.endswith(('.xml', '.osm.gz', '.osm.bz2'))]
     files.sort(key=lambda f: f['size'], reverse=True)
     files = files[:200]
 
-    place_lookup = {int(f['file'].name[:-4]): f for f in files}
+    place_lookup = {int(f['file'].name.partition('.')[0]): f for f in files}
     # q = Place.query.outerjoin(Changeset).filter(Place.place_id.in_(place_lookup.keys())).add_columns(func.count(Changeset.id))
     q = (database.session.query(Place, func.count(Changeset.id))
                          .outerjoin(Changeset)
@@ -5,6 +5,7 @@ from . import wikipedia, database, wikidata, netstring, utils, edit, mail
 from flask_login import current_user
 from .model import ItemCandidate, ChangesetEdit
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from lxml import etree
 from sqlalchemy.orm.attributes import flag_modified
 import requests
@@ -23,9 +24,64 @@ re_point = re.compile('^Point\(([-E0-9.]+) ([-E0-9.]+)\)$')
 # - match found
 # - match not found
 
+task_queue_reconnect_attempts = 10
+task_queue_reconnect_wait = 10  # seconds, long enough for a task queue restart
+wikidata_chunk_workers = 3  # chunks requested at once
+
 class VersionMismatch(Exception):
     pass
 
+def chunk_error(filename):
+    ''' Error message if the overpass chunk is a runtime error. '''
+    if (os.path.getsize(filename) > 2000 or
+            "<remark> runtime error" not in open(filename).read()):
+        return
+    root = etree.parse(filename).getroot()
+    return root.find('.//remark').text
+
+class ChunkLoader:
+    ''' Load chunks into PostGIS as they arrive and match the items they cover.
+
+    The first chunk is loaded with osm2pgsql --create and later chunks with
+    --append. Items are matched as soon as no chunk still to come overlaps
+    their search area, so matching overlaps with the download. '''
+    def __init__(self, m, chunks):
+        self.m = m
+        self.place = m.place
+        self.chunks = chunks
+        self.pending = {chunk['num'] for chunk in chunks if chunk['oql']}
+        self.created = False
+        # the old OSM data isn't loaded yet, only compare fingerprints for now
+        self.place.mark_changed_items_not_done(check_osm=False)
+
+    def chunk_done(self, num):
+        if num not in self.pending:
+            return
+        overpass_dir = current_app.config['OVERPASS_DIR']
+        filename = os.path.join(overpass_dir, self.chunks[num]['filename'])
+        if chunk_error(filename):
+            return  # reported once the download is complete
+
+        self.m.status(f'loading chunk {num} into PostGIS')
+        cmd = self.place.osm2pgsql_cmd(filename, append=self.created,
+                                       keep_slim=True)
+        env = {'PGPASSWORD': current_app.config['DB_PASS']}
+        subprocess.run(cmd, env=env, check=True)
+        self.created = True
+        self.pending.remove(num)
+
+        ready = self.place.items_clear_of([self.chunks[n]['bbox']
+                                           for n in self.pending])
+        if ready:
+            self.m.status(f'matching {len(ready)} items')
+            self.place.match_place_items(ready, progress=self.m.item_progress)
+
+    def finish(self):
+        for num in sorted(self.pending):
+            self.chunk_done(num)
+        self.place.drop_slim_tables()
+        self.place.mark_items_near_changed_osm_not_done()
+
 class MatcherSocket(object):
     def __init__(self, socket, place):
         self.socket = socket
@@ -77,43 +133,59 @@ class MatcherSocket(object):
         # FIXME - send error mail
 
     def wikidata_chunked(self, chunks):
-        items = {}
+        ''' Several chunks are requested at once, wikidata.query_workers caps
+        the number of queries in flight. '''
+        get_items = utils.with_app_context(wikidata.bbox_items)
+        results = {}
+        pending = {}
         num = 0
-        while chunks:
-            bbox = chunks.pop()
-            num += 1
-            msg = f'requesting wikidata chunk {num}'
-            print(msg)
-            self.status(msg)
-            try:
-                items.update(self.place.items_from_wikidata(bbox))
-            except wikidata.QueryTimeout:
-                msg = f'wikidata timeout, splitting chunk {num} info four'
-                print(msg)
-                self.status(msg)
-                chunks += bbox_chunk(bbox, 2)
+        with ThreadPoolExecutor(wikidata_chunk_workers) as executor:
+            while chunks or pending:
+                while chunks and len(pending) < wikidata_chunk_workers:
+                    bbox = chunks.pop()
+                    num += 1
+                    msg = f'requesting wikidata chunk {num}'
+                    print(msg)
+                    self.status(msg)
+                    pending[executor.submit(get_items, bbox)] = (num, bbox)
+
+                done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk_num, bbox = pending.pop(future)
+                    try:
+                        results[chunk_num] = future.result()
+                    except wikidata.QueryTimeout:
+                        msg = f'wikidata timeout, splitting chunk {chunk_num} info four'
+                        print(msg)
+                        self.status(msg)
+                        self.place.record_failed_chunk('wikidata', bbox)
+                        database.session.commit()
+                        chunks += bbox_chunk(bbox, 2)
 
+        items = {}
+        for chunk_num in sorted(results):  # merge in a fixed order
+            items.update(self.place.covered_items(results[chunk_num]))
         return items
 
     def get_items(self):
         self.send('get_wikidata_items')
         print('items from wikidata')
         place = self.place
-        chunk_size = place.wikidata_chunk_size()
-        if chunk_size == 1:
+        chunks = place.plan_chunks('wikidata')
+        if len(chunks) == 1:
             print('wikidata unchunked')
             try:
                 wikidata_items = place.items_from_wikidata()
             except wikidata.QueryTimeout:
                 place.wikidata_query_timeout = True
                 database.session.commit()
-                chunk_size = 2
+                chunks = place.plan_chunks('wikidata')
                 msg = 'wikidata query timeout, retrying with smaller chunks.'
                 self.status(msg)
+            else:
+                chunks = []
 
-        if chunk_size != 1:
-            chunks = list(place.polygon_chunk(size=32))
-
+        if chunks:
             msg = f'downloading wikidata in {len(chunks)} chunks'
             self.status(msg)
             wikidata_items = self.wikidata_chunked(chunks)
@@ -156,20 +228,43 @@ class MatcherSocket(object):
         sock.close()
         return reply['type'] == 'pong'
 
-    def overpass_request(self, chunks):
-        sock = self.connect_to_task_queue()
+    def overpass_request(self, chunks, on_chunk=None):
+        ''' Get chunks via the task queue, reattach if the task queue restarts.
 
+        on_chunk is called with the number of each chunk once it is on disk. '''
         fields = ['place_id', 'osm_id', 'osm_type', 'area']
-        msg = {
+        request = json.dumps({
             'place': {f: getattr(self.place, f) for f in fields},
             'chunks': chunks,
-        }
+        })
 
-        netstring.write(sock, json.dumps(msg))
+        sock = self.connect_to_task_queue()
+        for attempt in range(task_queue_reconnect_attempts):
+            try:
+                complete = self.read_task_queue(sock, request, on_chunk)
+            except (ConnectionResetError, netstring.NetstringError):
+                complete = None
+            sock.close()
+            if complete is not None:
+                return complete
+
+            self.status('lost connection to task queue, reconnecting')
+            sleep(task_queue_reconnect_wait)
+            try:
+                sock = self.connect_to_task_queue()
+            except ConnectionRefusedError:
+                continue
+        return False
+
+    def read_task_queue(self, sock, request, on_chunk=None):
+        ''' Relay task queue messages, returns None if the connection is lost. '''
+        netstring.write(sock, request)
+        reader = netstring.Reader(sock)
         complete = False
+        error = False
         while True:
             print('read')
-            from_network = netstring.read(sock)
+            from_network = reader.read()
             print('read complete')
             if from_network is None:
                 print('done')
@@ -185,15 +280,28 @@ class MatcherSocket(object):
             elif msg['type'] == 'chunk':
                 chunk_num = msg['num']
                 self.send('chunk_done', chunk_num=chunk_num)
+                if on_chunk:
+                    on_chunk(chunk_num)
             elif msg['type'] == 'done':
                 complete = True
                 self.send('overpass_done')
             elif msg['type'] == 'error':
+                error = True
                 self.error(msg['error'])
+            elif msg['type'] == 'split':
+                self.status('overpass query too big, split into four')
+                self.place.record_overpass_split(msg['bbox'])
+            elif msg['type'] == 'heartbeat':
+                if self.socket.closed:
+                    print('websocket closed, abandon overpass request')
+                    return False
+            elif msg['type'] == 'status' and 'queue_position' in msg:
+                self.status('queue position {queue_position}, '
+                            'estimated wait {estimated_wait} seconds'.format(**msg))
             else:
                 self.status('from network: ' + from_network)
             netstring.write(sock, 'ack')
-        return complete
+        return complete if (complete or error) else None
 
     def merge_chunks(self, chunks):
         files = [os.path.join('overpass', chunk['filename'])
@@ -222,9 +330,10 @@ class MatcherSocket(object):
 
         print('getting wikidata item details')
         self.status('getting wikidata item details')
-        for qid, entity in wikidata.entity_iter(db_items.keys()):
+        known = {qid: item.lastrevid for qid, item in db_items.items()}
+        for qid, entity in wikidata.updated_entity_iter(known):
             item = db_items[qid]
-            item.entity = entity
+            item.set_entity(entity)
             msg = 'load entity: ' + item.label_and_qid()
             print(msg)
             self.item_line(msg)
@@ -244,15 +353,15 @@ class MatcherSocket(object):
         self.status('osm2pgsql done')
         # could echo osm2pgsql output via websocket
 
-    def run_matcher(self):
-        def progress(candidates, item):
-            num = len(candidates)
-            noun = 'candidate' if num == 1 else 'candidates'
-            count = f': {num} {noun} found'
-            msg = item.label_and_qid() + count
-            self.item_line(msg)
+    def item_progress(self, candidates, item):
+        num = len(candidates)
+        noun = 'candidate' if num == 1 else 'candidates'
+        count = f': {num} {noun} found'
+        msg = item.label_and_qid() + count
+        self.item_line(msg)
 
-        self.place.run_matcher(progress=progress)
+    def run_matcher(self, reset=True):
+        self.place.run_matcher(progress=self.item_progress, reset=reset)
 
 def build_item_list(items):
     item_list = []
@@ -351,17 +460,26 @@ def run_matcher(place, m):
     chunks = place.get_chunks()
     m.report_empty_chunks(chunks)
 
+    pipelined = False
     if place.overpass_done:
         m.status('using existing overpass data')
     else:
         m.status('downloading data from overpass')
+        loader = None
+        if len(chunks) > 1 and current_app.config.get('PIPELINE_CHUNKS', True):
+            m.status('adding item type information')
+            place.load_isa()
+            loader = ChunkLoader(m, chunks)
         try:
-            overpass_good = m.overpass_request(chunks)
+            overpass_good = m.overpass_request(
+                chunks, on_chunk=loader.chunk_done if loader else None)
         except ConnectionRefusedError:
             m.error("unable to connect to task queue")
             database.session.commit()
             return
         if not overpass_good:
+            if m.socket.closed:
+                return
             m.error('overpass error')
             # FIXME: e-mail admin
             return
@@ -371,17 +489,20 @@ def run_matcher(place, m):
             if not chunk['oql']:
                 continue  # empty chunk
             filename = os.path.join(overpass_dir, chunk['filename'])
-            if (os.path.getsize(filename) > 2000 or
-                    "<remark> runtime error" not in open(filename).read()):
+            remark = chunk_error(filename)
+            if not remark:
                 continue
-            root = etree.parse(filename).getroot()
-            remark = root.find('.//remark')
-            m.error('overpass: ' + remark.text)
+            m.error('overpass: ' + remark)
             return  # FIXME report error to admin
 
         if len(chunks) > 1:
             m.merge_chunks(chunks)
-        place.state = 'postgis'
+        if loader:
+            loader.finish()
+            pipelined = True
+            place.state = 'load_isa'  # already loaded, ready to match
+        else:
+            place.state = 'postgis'
         database.session.commit()
 
     if place.state == 'postgis':
@@ -397,7 +518,7 @@ def run_matcher(place, m):
 
     if place.state == 'load_isa':
         m.status('running matcher')
-        m.run_matcher()
+        m.run_matcher(reset=not pipelined)  # done flags set by ChunkLoader
         place.state = 'ready'
         database.session.commit()
 
@@ -1,14 +1,40 @@
 from flask import render_template_string
 from urllib.parse import unquote
-from collections import defaultdict
-from .utils import chunk, drop_start, cache_filename
+from collections import defaultdict, deque, OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time
+from .utils import chunk, drop_start, cache_filename, with_app_context
 from .language import get_language_label
+from .disk_cache import app_cache, hash_key
 from . import user_agent_headers, overpass, mail, language, match, matcher
 import requests
+import threading
+import gzip
 import os
 import json
 
 page_size = 50
+entity_workers = 4  # wbgetentities requests in flight
+maxlag = 5  # seconds, see https://www.mediawiki.org/wiki/Manual:Maxlag_parameter
+api_attempts = 5
+api_retry_wait = 5  # seconds, when there is no Retry-After header
+wikidata_api_url = 'https://www.wikidata.org/w/api.php'
+local = threading.local()
+entity_projection_version = 1  # bump when project_entity changes
+query_workers = 4  # SPARQL queries in flight, shared by every caller
+query_slots = threading.BoundedSemaphore(query_workers)
+query_cache_ttl = {  # seconds, by kind of query
+    'default': 24 * 60 * 60,
+    'browse': 24 * 60 * 60,  # next level and up one level on the browse pages
+    'isa': 7 * 24 * 60 * 60,  # the type hierarchy changes slowly
+}
+revalidate_kinds = {'browse'}  # stale rows returned while a refresh runs
+query_cache_bytes = 1024 ** 3
+memory_cache_size = 256  # most recent results kept in memory
+memory_cache = OrderedDict()  # key -> (JSON bytes, expires)
+memory_cache_lock = threading.Lock()
+revalidating = set()
+cache_stats = Counter()  # hit, memory_hit, stale, miss
 report_missing_values = False
 wd_entity = 'http://www.wikidata.org/entity/Q'
 enwiki = 'https://en.wikipedia.org/wiki/'
@@ -442,20 +468,14 @@ def get_point_query(lat, lon, radius):
                                   lon=lon,
                                   radius=float(radius) / 1000.0)
 
-def run_query(query, name=None, timeout=None, send_error_mail=True):
-    if name:
-        filename = cache_filename(name + '.json')
-        if os.path.exists(filename):
-            return json.load(open(filename))['results']['bindings']
-
-    r = requests.post(wikidata_query_api_url,
-                      data={'query': query, 'format': 'json'},
-                      timeout=timeout,
-                      headers=user_agent_headers())
+def post_query(query, timeout=None, send_error_mail=True):
+    with query_slots:
+        r = requests.post(wikidata_query_api_url,
+                          data={'query': query, 'format': 'json'},
+                          timeout=timeout,
+                          headers=user_agent_headers())
     if r.status_code == 200:
-        if name:
-            open(filename, 'wb').write(r.content)
-        return r.json()['results']['bindings']
+        return r
 
     # query timeout generates two different exceptions
     # java.lang.RuntimeException: java.util.concurrent.ExecutionException: com.bigdata.bop.engine.QueryTimeoutException: Query deadline is expired.
@@ -470,6 +490,130 @@ def run_query(query, name=None, timeout=None, send_error_mail=True):
         mail.error_mail('wikidata query error', query, r)
     raise QueryError(query, r)
 
+def normalize_query(query):
+    return '\n'.join(' '.join(line.split()) for line in query.splitlines()
+                     if line.strip())
+
+def query_cache():
+    return app_cache('sparql', query_cache_bytes, query_cache_ttl['default'])
+
+def remember(key, data, expires):
+    with memory_cache_lock:
+        memory_cache[key] = (data, expires)
+        memory_cache.move_to_end(key)
+        while len(memory_cache) > memory_cache_size:
+            memory_cache.popitem(last=False)
+
+def cached_rows(cache, key):
+    ''' (rows, fresh) from memory or disk, rows is None if not cached. '''
+    with memory_cache_lock:
+        data, expires = memory_cache.get(key, (None, 0))
+    if data and time() < expires:
+        cache_stats['memory_hit'] += 1
+        return json.loads(data), True
+
+    hit = cache.lookup(key)
+    if not hit:
+        return None, False
+    data = gzip.decompress(open(hit.filename, 'rb').read())
+    if hit.fresh:
+        remember(key, data, hit.expires)
+    return json.loads(data), hit.fresh
+
+def store_rows(cache, key, rows, kind):
+    data = json.dumps(rows).encode('utf-8')
+    ttl = query_cache_ttl[kind]
+    cache.store(key, gzip.compress(data), ttl)
+    remember(key, data, time() + ttl)
+
+def revalidate(query, key, kind):
+    ''' Refresh a stale result in a background thread. '''
+    with memory_cache_lock:
+        if key in revalidating:
+            return
+        revalidating.add(key)
+
+    def refresh():
+        try:
+            r = post_query(query, send_error_mail=False)
+            store_rows(query_cache(), key, r.json()['results']['bindings'], kind)
+        except (QueryError, requests.exceptions.RequestException):
+            pass  # keep serving the stale rows
+        finally:
+            with memory_cache_lock:
+                revalidating.discard(key)
+
+    threading.Thread(target=with_app_context(refresh), daemon=True).start()
+
+def run_query(query, name=None, timeout=None, send_error_mail=True,
+              kind='default'):
+    ''' Rows from the query service, cached by the normalized query text for
+    query_cache_ttl[kind] seconds. Use kind=None for results that need to be
+    current. A stale result is used if the query service fails. '''
+    if name:
+        filename = cache_filename(name + '.json')
+        if os.path.exists(filename):
+            return json.load(open(filename))['results']['bindings']
+
+    cache = query_cache() if kind else None
+    rows = None
+    if cache:
+        key = hash_key(normalize_query(query))
+        rows, fresh = cached_rows(cache, key)
+        if rows is not None and fresh:
+            cache_stats['hit'] += 1
+            return rows
+        if rows is not None and kind in revalidate_kinds:
+            cache_stats['stale'] += 1
+            revalidate(query, key, kind)
+            return rows
+        cache_stats['miss'] += 1
+
+    try:
+        r = post_query(query, timeout=timeout, send_error_mail=send_error_mail)
+    except (QueryError, requests.exceptions.RequestException):
+        if rows is None:
+            raise
+        return rows
+
+    if name:
+        open(filename, 'wb').write(r.content)
+    fetched = r.json()['results']['bindings']
+    if cache:
+        store_rows(cache, key, fetched, kind)
+    return fetched
+
+def run_queries(queries):
+    ''' Start the queries in worker threads, returns a future for each. '''
+    executor = ThreadPoolExecutor(len(queries))
+    run = with_app_context(run_query)
+    futures = [executor.submit(run, query, kind=None) for query in queries]
+    executor.shutdown(wait=False)
+    return futures
+
+def optional_rows(future):
+    try:
+        return future.result()
+    except QueryError:
+        return []  # HQ query timeout isn't fatal
+
+def bbox_items(bbox):
+    ''' Items in a bounding box from the enwiki and item tag queries, and the
+    versions that use the coordinates in the HQ field. The four queries run
+    concurrently, results are merged in a fixed order. '''
+    enwiki, enwiki_hq, item_tag, hq_item_tag = run_queries([
+        get_enwiki_query(*bbox),
+        get_enwiki_hq_query(*bbox),
+        get_item_tag_query(*bbox),
+        get_hq_item_tag_query(*bbox),
+    ])
+
+    items = parse_enwiki_query(enwiki.result())
+    items.update(parse_enwiki_query(optional_rows(enwiki_hq)))
+    parse_item_tag_query(item_tag.result(), items)
+    parse_item_tag_query(optional_rows(hq_item_tag), items)
+    return items
+
 def flatten_criteria(items):
     start = {'Tag:' + i[4:] + '=' for i in items if i.startswith('Key:')}
     return {i for i in items if not any(i.startswith(s) for s in start)}
@@ -526,38 +670,93 @@ def parse_item_tag_query(rows, items):
                     items[qid][k] = row[k]['value']
         items[qid]['tags'].add(tag_or_key)
 
-def entity_iter(ids, debug=False):
-    wikidata_url = 'https://www.wikidata.org/w/api.php'
-    params = {
-        'format': 'json',
-        'formatversion': 2,
-        'action': 'wbgetentities',
-    }
-    for num, cur in enumerate(chunk(ids, page_size)):
-        if debug:
-            print('entity_iter: {}/{}'.format(num * page_size, len(ids)))
-        params['ids'] = '|'.join(cur)
-        r = requests.get(wikidata_url,
-                         params=params,
-                         headers=user_agent_headers())
+class APIError(Exception):
+    pass
+
+def api_session():
+    ''' Keep-alive session for the Wikidata API, one per thread. '''
+    if not hasattr(local, 'session'):
+        local.session = requests.Session()
+        local.session.headers.update(user_agent_headers())
+    return local.session
+
+def retry_wait(r):
+    try:
+        return int(r.headers.get('Retry-After', api_retry_wait))
+    except ValueError:
+        return api_retry_wait
+
+def api_get(params):
+    ''' Call the Wikidata API, backing off while the servers are lagged or
+    we are being rate limited. '''
+    params = dict(params, format='json', formatversion=2, maxlag=maxlag)
+    for attempt in range(api_attempts):
+        r = api_session().get(wikidata_api_url, params=params)
+        if r.status_code in (429, 503):
+            sleep(retry_wait(r))
+            continue
         r.raise_for_status()
         json_data = r.json()
-        for qid, entity in json_data['entities'].items():
-            yield qid, entity
+        error = json_data.get('error')
+        if not error:
+            return json_data
+        if error.get('code') != 'maxlag':
+            raise APIError(error)
+        sleep(retry_wait(r))
+    raise APIError('gave up after {} attempts'.format(api_attempts))
+
+def entity_batch(ids, props=None):
+    params = {'action': 'wbgetentities', 'ids': '|'.join(ids)}
+    if props:
+        params['props'] = props
+    return list(api_get(params)['entities'].items())
+
+def entity_iter(ids, debug=False, workers=entity_workers, props=None):
+    ''' Yield (qid, entity) in batch order, with several batches in flight. '''
+    ids = list(ids)
+    in_flight = deque()
+    done = 0
+
+    def next_batch():
+        nonlocal done
+        batch = in_flight.popleft().result()
+        done += len(batch)
+        if debug:
+            print('entity_iter: {}/{}'.format(done, len(ids)))
+        return batch
+
+    with ThreadPoolExecutor(workers) as executor:
+        for cur in chunk(ids, page_size):
+            in_flight.append(executor.submit(entity_batch, cur, props))
+            if len(in_flight) >= workers:
+                yield from next_batch()
+        while in_flight:
+            yield from next_batch()
+
+def entity_revisions(ids):
+    ''' Current lastrevid of each entity, None for missing entities. '''
+    return {qid: entity.get('lastrevid')
+            for qid, entity in entity_iter(ids, props='info')}
+
+def updated_entity_iter(known, debug=False):
+    ''' Fetch entities that are new or changed.
+
+    known maps QID to the lastrevid we have, or None if we have no entity. Only
+    revision IDs are downloaded for the ones we have, full entities are then
+    downloaded for the ones that changed. '''
+    have = [qid for qid, lastrevid in known.items() if lastrevid]
+    current = entity_revisions(have) if have else {}
+    if debug:
+        unchanged = sum(current.get(qid) == known[qid] for qid in have)
+        print('entities unchanged: {}/{}'.format(unchanged, len(known)))
+    changed = [qid for qid, lastrevid in known.items()
+               if not lastrevid or current.get(qid) != lastrevid]
+    return entity_iter(changed, debug=debug)
 
 def get_entity(qid):
-    wikidata_url = 'https://www.wikidata.org/w/api.php'
-    params = {
-        'format': 'json',
-        'formatversion': 2,
-        'action': 'wbgetentities',
-        'ids': qid,
-    }
-    json_data = requests.get(wikidata_url,
-                             params=params,
-                             headers=user_agent_headers()).json()
+    params = {'action': 'wbgetentities', 'ids': qid}
     try:
-        entity = list(json_data['entities'].values())[0]
+        entity = list(api_get(params)['entities'].values())[0]
     except KeyError:
         return None
     if 'missing' not in entity:
@@ -572,17 +771,29 @@ def entity_label(entity):
 def get_entities(ids):
     if not ids:
         return []
-    wikidata_url = 'https://www.wikidata.org/w/api.php'
-    params = {
-        'format': 'json',
-        'formatversion': 2,
-        'action': 'wbgetentities',
-        'ids': '|'.join(ids),
-    }
-    json_data = requests.get(wikidata_url,
-                             params=params,
-                             headers=user_agent_headers()).json()
-    return list(json_data['entities'].values())
+    return [entity for qid, entity in entity_batch(ids)]
+
+def project_claim(claim):
+    mainsnak = claim['mainsnak']
+    if 'datavalue' not in mainsnak:
+        return {'mainsnak': {}}
+    return {'mainsnak': {'datavalue': {'value': mainsnak['datavalue']['value']}}}
+
+def project_entity(entity, claims=()):
+    ''' Keep only the parts of a wbgetentities entity that we read: labels,
+    aliases, sitelinks and the main value of the given claims. '''
+    if entity.get('projection') == entity_projection_version:
+        return entity
+    ret = {k: entity[k] for k in ('id', 'lastrevid', 'missing') if k in entity}
+    ret['projection'] = entity_projection_version
+    ret['labels'] = entity.get('labels', {})
+    ret['aliases'] = entity.get('aliases', {})
+    ret['sitelinks'] = {site: {'site': site, 'title': v['title']}
+                        for site, v in entity.get('sitelinks', {}).items()}
+    ret['claims'] = {pid: [project_claim(c) for c in values]
+                     for pid, values in entity.get('claims', {}).items()
+                     if pid in claims}
+    return ret
 
 def names_from_entity(entity, skip_lang=None):
     if not entity:
@@ -686,7 +897,7 @@ def get_location_hierarchy(qid, name=None):
 def up_one_level(qid, name=None):
     query = up_one_level_query.replace('QID', qid)
     try:
-        rows = run_query(query, name=name, timeout=2)
+        rows = run_query(query, name=name, timeout=2, kind='browse')
     except requests.Timeout:
         return
 
@@ -748,7 +959,7 @@ def next_level_places(qid, entity, name=None):
     query = get_next_level_query(qid, entity)
 
     rows = []
-    for row in run_query(query, name=name):
+    for row in run_query(query, name=name, kind='browse'):
         item_id = wd_uri_to_id(row['item']['value'])
         qid = 'Q{:d}'.format(item_id)
         isa_list = []
@@ -844,7 +1055,7 @@ def item_types_graph(items, name=None):
     query = item_types_tree.replace('ITEMS', query_items)
 
     graph = {}
-    for row in run_query(query, name=name, send_error_mail=False):
+    for row in run_query(query, name=name, send_error_mail=False, kind='isa'):
         item_qid = wd_to_qid(row['item'])
         type_qid = wd_to_qid(row['type'])
         if not item_qid or not type_qid:
@@ -971,14 +1182,14 @@ def get_item_types(items, name=None):  # unused
                        .replace('TYPES', query_types))
 
     return {(wd_to_qid(row['item']), wd_to_qid(row['type']))
-            for row in run_query(query, name=name)}
+            for row in run_query(query, name=name, kind='isa')}
 
 def find_superclasses(items, name=None):
     query_items = ' '.join(f'(wd:{qid})' for qid in items)
     query = subclasses.replace('ITEMS', query_items)
 
     return {(wd_to_qid(row['item']), wd_to_qid(row['type']))
-            for row in run_query(query, name=name)}
+            for row in run_query(query, name=name, kind='isa')}
 
 def claim_value(claim):
     try:
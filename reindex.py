@@ -1,10 +1,10 @@
 #!/usr/bin/python3
-from matcher.model import Place, Item, ItemCandidate
-from matcher import database, user_agent_headers, matcher, wikidata
+from matcher.model import Place, Item, upsert_candidates
+from matcher import database, matcher, wikidata, overpass
+from matcher.utils import chunk
 from matcher.view import app
 from matcher.overpass import wait_for_slot, get_status  # noqa: F401
 from time import sleep
-import requests
 import sys
 
 def do_reindex(place, force=False):
@@ -46,14 +46,16 @@ def do_reindex(place, force=False):
     if not all(t in tables for t in expect) or place.all_tags != all_tags:
         if not place.overpass_done:
             oql = place.get_oql()
-            overpass_url = 'https://overpass-api.de/api/interpreter'
+            overpass_url = 'https://overpass-api.de'
 
             wait_for_slot()
             print('running overpass query')
-            r = requests.post(overpass_url, data=oql, headers=user_agent_headers())
+            try:
+                overpass.download(oql, place.overpass_filename, url=overpass_url)
+            except overpass.OverpassError as e:
+                print('overpass error:', e.r.status_code, e.r.text)
+                return  # no OSM data to load, leave the place for a later run
             print('overpass done')
-
-            place.save_overpass(r.content)
         place.state = 'postgis'
         database.session.commit()
 
@@ -66,14 +68,12 @@ def do_reindex(place, force=False):
     cur = conn.cursor()
 
     q = place.items.filter(Item.entity.isnot(None)).order_by(Item.item_id)
-    for item in q:
-        candidates = matcher.find_item_matches(cur, item, place.prefix, debug=False)
-        for i in (candidates or []):
-            c = ItemCandidate.query.get((item.item_id, i['osm_id'], i['osm_type']))
-            if not c:
-                c = ItemCandidate(**i, item=item)
-                database.session.add(c)
-        print(len(candidates), item.label)
+    for batch in chunk(q, 500):
+        found = {}
+        for item, candidates in matcher.find_batch_item_matches(cur, batch, place.prefix):
+            found[item.item_id] = candidates
+            print(len(candidates), item.label)
+        upsert_candidates(found)
     place.state = 'ready'
     database.session.commit()
 
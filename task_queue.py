@@ -1,31 +1,36 @@
 #!/usr/bin/python3
 from gevent.server import StreamServer
-from gevent.queue import PriorityQueue, Queue
-from gevent import monkey, spawn, sleep
+from gevent.queue import Queue, Empty
+from gevent.event import Event
+from gevent import monkey, spawn, spawn_later, sleep
 monkey.patch_all()
 
 from matcher import overpass, netstring, utils, mail
 from matcher.view import app
+from time import time
 import requests.exceptions
+import sqlite3
 import json
 import os.path
 
-# Priority queue
-# We should switch to a priority queue ordered by number of chunks
-# if somebody requests a place with 10 chunks they should go to the back
-# of the queue
-#
-# Abort request
-# If a user gives up and closes the page do we should remove their request from
-# the queue if nobody else has made the same request.
-#
-# We can tell the page was closed by checking a websocket heartbeat.
-
 app.config.from_object('config.default')
 
-task_queue = PriorityQueue()
+endpoints = []
+# Requests for a place in progress, keyed on place_id. Every client asking for
+# the same place with the same chunk plan subscribes to one download.
+places = {}
+# Requests are kept in SQLite until finished, so they survive a restart.
+store = None
 
 listen_host, port = 'localhost', 6020
+workers_per_endpoint = 2
+max_chunk_attempts = 3
+endpoint_down_seconds = 60
+heartbeat_seconds = 30
+max_batch = 100  # messages sent to the client before reading the acks
+aging_cost_per_second = 1.0  # priority a request gains for each second waiting
+default_seconds_per_cost = 1.0  # used for estimated wait until chunks are timed
+reattach_seconds = 300  # restored requests nobody reattaches to are dropped
 
 # almost there
 # should give status update as each chunk is loaded.
@@ -35,80 +40,361 @@ def to_client(send_queue, msg_type, msg):
     msg['type'] = msg_type
     send_queue.put(msg)
 
-def wait_for_slot(send_queue):
-    print('get status')
-    try:
-        status = overpass.get_status()
-    except overpass.OverpassError as e:
-        r = e.args[0]
-        body = f'URL: {r.url}\n\nresponse:\n{r.text}'
-        mail.send_mail('Overpass API unavailable', body)
-        send_queue.put({'type': 'error',
-                        'error': "Can't access overpass API"})
-        return False
-    except requests.exceptions.Timeout:
-        body = 'Timeout talking to overpass API'
-        mail.send_mail('Overpass API timeout', body)
-        send_queue.put({'type': 'error',
-                        'error': "Can't access overpass API"})
-        return False
-
-    print('status:', status)
-    if not status['slots']:
-        return True
-    secs = status['slots'][0]
-    if secs <= 0:
+def to_subscribers(item, msg_type, msg):
+    ''' Send to every client waiting for this place, kept for late joiners. '''
+    msg['type'] = msg_type
+    if msg_type != 'status':
+        item['history'].append(msg)
+    for send_queue in item['subscribers']:
+        send_queue.put(dict(msg))
+
+def open_store():
+    filename = (app.config.get('TASK_QUEUE_DB') or
+                os.path.join(app.config['DATA_DIR'], 'task_queue.sqlite'))
+    db = sqlite3.connect(filename, isolation_level=None)
+    db.execute('create table if not exists request '
+               '(place_id integer primary key, place text, chunks text, added real)')
+    return db
+
+def save_request(item):
+    if store:
+        store.execute('insert or replace into request values (?, ?, ?, ?)',
+                      (item['place']['place_id'], json.dumps(item['place']),
+                       json.dumps(item['chunks']), item['added']))
+
+def delete_request(item):
+    if store:
+        store.execute('delete from request where place_id = ?',
+                      (item['place']['place_id'],))
+
+def restore_requests():
+    ''' Queue the requests that were unfinished when the task queue stopped.
+
+    Chunks already on disk aren't fetched again. Clients reattach by asking for
+    the same place. '''
+    rows = store.execute('select place, chunks, added from request order by added')
+    for place, chunks, added in rows.fetchall():
+        place = json.loads(place)
+        print('restore request for place', place['place_id'])
+        item = new_item(place, json.loads(chunks), added=added)
+        item['restored'] = True
+        places[place['place_id']] = item
+        add_place_request(item)
+    spawn_later(reattach_seconds, drop_unclaimed)
+
+def drop_unclaimed():
+    for item in list(places.values()):
+        if item.get('restored') and not item['subscribers']:
+            cancel(item)
+
+def new_item(place, chunks, added=None):
+    return {
+        'place': place,
+        'chunks': chunks,
+        'subscribers': [],
+        'history': [],
+        'added': added or time(),
+    }
+
+def finish(item):
+    item['finished'] = True
+    if places.get(item['place']['place_id']) is item:
+        del places[item['place']['place_id']]
+        delete_request(item)
+    for send_queue in item['subscribers']:
+        send_queue.put(None)
+
+def same_plan(a, b):
+    return ([(c['filename'], c['oql']) for c in a] ==
+            [(c['filename'], c['oql']) for c in b])
+
+def subscribe(place, chunks, send_queue):
+    ''' Join the download of a place already in progress, or start one.
+
+    Chunk messages refer to chunks by number, so only a client with the same
+    chunk plan can join. A new plan replaces the request in places, the old
+    request carries on for the clients already subscribed. '''
+    item = places.get(place['place_id'])
+    if item and not same_plan(item['chunks'], chunks):
+        print('new chunk plan for place', place['place_id'])
+        item = None
+    if item:
+        print('joining request for place', place['place_id'])
+        item['subscribers'].append(send_queue)
+        for msg in item['history']:
+            send_queue.put(dict(msg))
+        return item
+
+    item = new_item(place, chunks)
+    item['subscribers'].append(send_queue)
+    places[place['place_id']] = item
+    save_request(item)
+    add_place_request(item)
+    return item
+
+def cancel(item):
+    print('cancel request for place', item['place']['place_id'])
+    scheduler.remove(item)
+    finish(item)
+
+def unsubscribe(item, send_queue):
+    ''' Client went away, cancel the download if nobody else wants it. '''
+    if send_queue in item['subscribers']:
+        item['subscribers'].remove(send_queue)
+    if not item['subscribers'] and not item['finished']:
+        cancel(item)
+
+class Endpoint:
+    ''' An Overpass server, with slot and rate limit state from /api/status. '''
+    def __init__(self, url):
+        self.url = url
+        self.status = None
+        self.down_until = 0
+
+    def __repr__(self):
+        return f'Endpoint({self.url!r})'
+
+    @property
+    def is_down(self):
+        return time() < self.down_until
+
+    def mark_down(self, subject, body):
+        if not self.is_down:
+            mail.send_mail(subject, f'endpoint: {self.url}\n\n{body}')
+        self.down_until = time() + endpoint_down_seconds
+
+    def wait_for_slot(self, item):
+        print('get status:', self.url)
+        try:
+            self.status = overpass.get_status(overpass.status_url(self.url))
+        except overpass.OverpassError as e:
+            r = e.args[0]
+            self.mark_down('Overpass API unavailable',
+                           f'URL: {r.url}\n\nresponse:\n{r.text}')
+            return False
+        except requests.exceptions.RequestException:
+            self.mark_down('Overpass API timeout',
+                           'Timeout talking to overpass API')
+            return False
+
+        print('status:', self.url, self.status)
+        if not self.status['slots']:
+            return True
+        secs = self.status['slots'][0]
+        if secs <= 0:
+            return True
+        to_subscribers(item, 'status', {'wait': secs})
+        sleep(secs)
         return True
-    send_queue.put({'type': 'status', 'wait': secs})
-    sleep(secs)
-    return True
 
-def process_queue_loop():
-    with app.app_context():
+def get_endpoints():
+    urls = app.config.get('OVERPASS_URLS') or [app.config['OVERPASS_URL']]
+    return [Endpoint(url) for url in urls]
+
+def chunk_cost(chunk):
+    ''' Estimated Overpass cost of a chunk, one per statement in the query. '''
+    return max(chunk['oql'].count(';'), 1)
+
+def wanted_by_other_endpoint(job, endpoint):
+    ''' This endpoint already failed on the job and there is another to try. '''
+    return (endpoint.url in job['tried'] and
+            any(e.url not in job['tried'] and not e.is_down for e in endpoints))
+
+class ChunkScheduler:
+    ''' Chunks waiting to be fetched, from every place request.
+
+    Requests are ranked by the estimated cost of their remaining chunks, less
+    an allowance for time spent waiting so big requests don't starve. Workers
+    take one chunk at a time, so a small place isn't stuck behind every chunk
+    of a big one. '''
+
+    def __init__(self):
+        self.items = []
+        self.changed = Event()
+        self.seconds_per_cost = default_seconds_per_cost
+        self.workers = 1
+
+    def priority(self, item, now):
+        return item['cost'] - aging_cost_per_second * (now - item['added'])
+
+    def ranked(self):
+        now = time()
+        return sorted(self.items, key=lambda item: self.priority(item, now))
+
+    def add(self, item):
+        item['started'] = False
+        self.items.append(item)
+        self.changed.set()
+        self.send_queue_status()
+
+    def remove(self, item):
+        if item in self.items:
+            self.items.remove(item)
+            self.send_queue_status()
+
+    def put_back(self, job):
+        item = job['item']
+        if item['finished']:
+            return
+        item['jobs'].insert(0, job)
+        item['cost'] += job['cost']
+        if item not in self.items:
+            self.items.append(item)
+        self.changed.set()
+
+    def pick(self, endpoint):
+        for item in self.ranked():
+            for job in item['jobs']:
+                if wanted_by_other_endpoint(job, endpoint):
+                    continue
+                item['jobs'].remove(job)
+                item['cost'] -= job['cost']
+                item['started'] = True
+                if not item['jobs']:
+                    self.remove(item)
+                return job
+
+    def get(self, endpoint):
         while True:
-            process_queue()
+            self.changed.clear()
+            job = self.pick(endpoint)
+            if job:
+                return job
+            self.changed.wait(timeout=1)
+
+    def record_time(self, job, seconds):
+        ''' Update the estimate of how long a chunk takes. '''
+        rate = seconds / job['cost']
+        self.seconds_per_cost = 0.8 * self.seconds_per_cost + 0.2 * rate
 
-def process_queue():
-    area, item = task_queue.get()
-    place = item['place']
-    send_queue = item['queue']
+    def send_queue_status(self):
+        ''' Tell requests still waiting for their first chunk where they are. '''
+        cost_ahead = 0
+        for position, item in enumerate(self.ranked(), 1):
+            if not item['started']:
+                wait = cost_ahead * self.seconds_per_cost / self.workers
+                to_subscribers(item, 'status', {
+                    'queue_position': position,
+                    'estimated_wait': round(wait),
+                })
+            cost_ahead += item['cost']
+
+scheduler = ChunkScheduler()
+
+def add_place_request(item):
+    ''' Split a place request into chunk jobs for the endpoint workers. '''
+    item['remaining'] = 0
+    item['finished'] = False
+    item['jobs'] = []
+    item['cost'] = 0
     for num, chunk in enumerate(item['chunks']):
-        oql = chunk.get('oql')
-        if not oql:
+        if not chunk.get('oql'):
             continue
-        filename = 'overpass/' + chunk['filename']
         msg = {
             'num': num,
             'filename': chunk['filename'],
-            'place': place,
+            'place': item['place'],
         }
-        if not os.path.exists(filename):
-            utils.check_free_space(app.config)
-            if not wait_for_slot(send_queue):
-                return
-            to_client(send_queue, 'run_query', msg)
-            print('run query')
-            r = overpass.run_query(oql)
-            print('query complete')
-            with open(filename, 'wb') as out:
-                out.write(r.content)
-            utils.check_free_space(app.config)
-        print(msg)
-        to_client(send_queue, 'chunk', msg)
-    print('item complete')
-    send_queue.put(None)
+        if os.path.exists('overpass/' + chunk['filename']):
+            to_subscribers(item, 'chunk', msg)
+            continue
+        item['remaining'] += 1
+        cost = chunk_cost(chunk)
+        item['jobs'].append({'item': item, 'num': num, 'chunk': chunk,
+                             'msg': msg, 'tried': set(), 'attempts': 0,
+                             'cost': cost})
+        item['cost'] += cost
+
+    if item['remaining']:
+        scheduler.add(item)
+    else:
+        print('item complete')
+        finish(item)
+
+def chunk_complete(item):
+    item['remaining'] -= 1
+    if not item['remaining'] and not item['finished']:
+        print('item complete')
+        finish(item)
+
+def chunk_failed(job, endpoint):
+    ''' Give the chunk to another endpoint, or report an error to the client. '''
+    item = job['item']
+    if item['finished']:  # cancelled, nobody is waiting for the chunk
+        return
+    job['tried'].add(endpoint.url)
+    job['attempts'] += 1
+    if job['attempts'] < max_chunk_attempts:
+        scheduler.put_back(job)
+        return
+    scheduler.remove(item)
+    to_subscribers(item, 'error', {'error': "Can't access overpass API"})
+    finish(item)
+
+def chunk_split(item, bbox):
+    ''' Overpass needed a smaller query, the websocket records it on the place. '''
+    to_subscribers(item, 'split', {'bbox': bbox})
+
+def run_chunk(endpoint, job):
+    item = job['item']
+    msg = job['msg']
+    filename = 'overpass/' + job['chunk']['filename']
+
+    utils.check_free_space(app.config)
+    if not endpoint.wait_for_slot(item):
+        return chunk_failed(job, endpoint)
+    to_subscribers(item, 'run_query', dict(msg))
+    print('run query:', endpoint.url, msg)
+    start = time()
+    try:
+        overpass.download_split(job['chunk']['oql'], filename, url=endpoint.url,
+                                on_split=lambda bbox: chunk_split(item, bbox))
+    except requests.exceptions.RequestException as e:
+        print('query failed:', endpoint.url, e)
+        return chunk_failed(job, endpoint)
+    except overpass.OverpassError as e:
+        print('query failed:', endpoint.url, e.r.status_code)
+        return chunk_failed(job, endpoint)
+    print('query complete')
+    scheduler.record_time(job, time() - start)
+
+    utils.check_free_space(app.config)
+    print(msg)
+    to_subscribers(item, 'chunk', dict(msg))
+    chunk_complete(item)
+
+def endpoint_worker(endpoint):
+    with app.app_context():
+        while True:
+            if endpoint.is_down:
+                sleep(endpoint.down_until - time())
+                continue
+            job = scheduler.get(endpoint)
+            if job['item']['finished']:
+                continue
+            run_chunk(endpoint, job)
 
 class Request:
     def __init__(self, sock, address):
         self.address = address
         self.sock = sock
+        self.reader = netstring.Reader(sock)
         self.send_queue = None
+        self.item = None
 
     def send_msg(self, msg, check_ack=True):
-        netstring.write(self.sock, json.dumps(msg))
         if check_ack:
-            msg = netstring.read(self.sock)
-            assert msg == 'ack'
+            return self.send_msgs([msg])
+        netstring.write(self.sock, json.dumps(msg))
+
+    def send_msgs(self, msgs):
+        ''' Send messages in a single write, then read the ack for each. '''
+        netstring.write_many(self.sock, [json.dumps(msg) for msg in msgs])
+        for _ in msgs:
+            ack = self.reader.read()
+            if ack is None:
+                raise ConnectionResetError('client closed the connection')
+            assert ack == 'ack'
 
     def reply_and_close(self, msg):
         self.send_msg(msg, check_ack=False)
@@ -116,19 +402,33 @@ class Request:
 
     def new_place_request(self, msg):
         self.send_queue = Queue()
-        task_queue.put((msg['place']['area'], {
-            'place': msg['place'],
-            'address': self.address,
-            'chunks': msg['chunks'],
-            'queue': self.send_queue,
-        }))
+        self.item = subscribe(msg['place'], msg['chunks'], self.send_queue)
 
         self.send_msg({'type': 'connected'})
 
+    def next_msgs(self):
+        ''' Messages waiting for the client, or a heartbeat if there are none.
+
+        None as the last message means the request is complete. '''
+        try:
+            msgs = [self.send_queue.get(timeout=heartbeat_seconds)]
+        except Empty:
+            return [{'type': 'heartbeat'}]
+        while (msgs[-1] is not None and len(msgs) < max_batch and
+               not self.send_queue.empty()):
+            msgs.append(self.send_queue.get_nowait())
+        return msgs
+
     def handle(self):
         print('New connection from %s:%s' % self.address)
         try:
-            msg = json.loads(netstring.read(self.sock))
+            msg = self.reader.read()
+        except netstring.NetstringError as e:
+            return self.reply_and_close({'type': 'error', 'error': str(e)})
+        if msg is None:
+            return self.sock.close()
+        try:
+            msg = json.loads(msg)
         except json.decoder.JSONDecodeError:
             msg = {'type': 'error', 'error': 'invalid JSON'}
             return self.reply_and_close(msg)
@@ -139,14 +439,19 @@ class Request:
         self.new_place_request(msg)
         error = False
         try:
-            to_send = self.send_queue.get()
-            while to_send:
-                self.send_msg(to_send)
-                if to_send['type'] == 'error':
+            complete = False
+            while not complete:
+                msgs = self.next_msgs()
+                complete = msgs[-1] is None
+                if complete:
+                    msgs.pop()
+                if msgs:
+                    self.send_msgs(msgs)
+                if any(msg['type'] == 'error' for msg in msgs):
                     error = True
-                to_send = self.send_queue.get()
-        except BrokenPipeError:
+        except (BrokenPipeError, ConnectionResetError, netstring.NetstringError):
             print('socket closed')
+            unsubscribe(self.item, self.send_queue)
         else:
             if not error:
                 print('request complete')
@@ -159,8 +464,16 @@ def handle_request(sock, address):
     return r.handle()
 
 def main():
+    global store
     utils.check_free_space(app.config)
-    spawn(process_queue_loop)
+    endpoints[:] = get_endpoints()
+    workers = app.config.get('OVERPASS_WORKERS', workers_per_endpoint)
+    scheduler.workers = workers * len(endpoints)
+    for endpoint in endpoints:
+        for _ in range(workers):
+            spawn(endpoint_worker, endpoint)
+    store = open_store()
+    restore_requests()
     print('listening on port {}'.format(port))
     server = StreamServer((listen_host, port), handle_request)
     server.serve_forever()
@@ -0,0 +1,10 @@
+from flask import Flask
+import benchmark
+
+def test_benchmark_fixtures():
+    app = Flask('test_benchmark')
+    app.config['DATA_DIR'] = 'data'
+    with app.app_context():
+        fixtures = benchmark.load_fixtures()
+        assert fixtures
+        assert benchmark.check_results(fixtures) == []
@@ -0,0 +1,56 @@
+from matcher.disk_cache import DiskCache, hash_key
+import threading
+import time
+
+def test_store_and_lookup(tmpdir):
+    cache = DiskCache(str(tmpdir), budget=1000, ttl=60)
+    key = hash_key('query')
+    assert cache.lookup(key) is None
+
+    cache.store(key, b'data')
+    hit = cache.lookup(key)
+    assert hit.fresh
+    assert open(hit.filename, 'rb').read() == b'data'
+
+    cache.store(key, b'old', ttl=-1)
+    assert not cache.lookup(key).fresh
+
+def test_store_file(tmpdir):
+    cache = DiskCache(str(tmpdir.join('cache')), budget=1000, ttl=60)
+    filename = tmpdir.join('download.xml')
+    filename.write('<osm/>')
+    cache.store_file('abc', str(filename))
+    filename.remove()
+    assert open(cache.lookup('abc').filename).read() == '<osm/>'
+
+def test_evict_least_recently_used(tmpdir):
+    cache = DiskCache(str(tmpdir), budget=25, ttl=60)
+    for key in 'abc':
+        cache.store(key, b'x' * 10)
+        if key == 'b':
+            time.sleep(0.01)
+            cache.lookup('a')
+
+    assert cache.lookup('a')
+    assert cache.lookup('b') is None
+    assert cache.lookup('c')
+    assert cache.total_size() == 20
+
+def test_store_from_threads(tmpdir):
+    cache = DiskCache(str(tmpdir), budget=10 ** 6, ttl=60)
+    errors = []
+
+    def store():
+        try:
+            for attempt in range(50):
+                cache.store('same', b'x' * 10000)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=store) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    assert open(cache.lookup('same').filename, 'rb').read() == b'x' * 10000
@@ -77,6 +77,15 @@ def test_normalize_name():
     assert match.normalize_name('TEST TEST') == 'testtest'
     assert match.normalize_name('testtest') == 'testtest'
 
+def test_name_cache():
+    match.normalize_name.cache_clear()
+    assert match.normalize_name('St 3rd Street') == 'stthirdstreet'
+    assert match.normalize_name('St 3rd Street') == 'stthirdstreet'
+
+    info = match.name_cache_info()['normalize_name']
+    assert (info.hits, info.misses) == (1, 1)
+    assert info.maxsize == match.name_cache_size
+
 def test_has_address():
     assert not match.has_address({})
     assert match.has_address({'addr:full': '1 Station Road'})
@@ -542,6 +551,29 @@ def test_check_for_address_in_extract():
     }
     assert match.check_for_address_in_extract(osm_tags, extract)
 
+def test_name_match_keys():
+    pairs = [
+        ('BBC', 'British Broadcasting Corporation'),
+        ("St Mary's Church", 'Saint Mary Church'),
+        ('Houseboat', 'Boat'),
+        ('Cafe Rouge', 'Café Rouge'),
+        ('Corn Exchange', 'Corn Exchange, Leeds'),
+        ('Old Vic; RAH', 'Royal Albert Hall'),
+        ('Cyrus', 'Tomb of Cyrus'),
+        ('Museum of Oxford', 'Museum'),
+    ]
+    endings = frozenset(['museum'])
+    place_names = frozenset(['Oxford'])
+    for osm, wd in pairs:
+        assert match.name_match(osm, wd, endings, place_names=place_names)
+        osm_keys = match.name_match_keys(osm, True, endings, place_names)
+        wd_keys = match.name_match_keys(wd, False, endings, place_names)
+        assert osm_keys & wd_keys
+
+    osm_keys = match.name_match_keys('Tesco', True, endings, place_names)
+    wd_keys = match.name_match_keys('Royal Albert Hall', False, endings, place_names)
+    assert not (osm_keys & wd_keys)
+
 def test_check_for_match():
     assert match.check_for_match({}, []) == {}
 
@@ -1,17 +1,21 @@
 from matcher import matcher
 from matcher.model import Item
 import os.path
+import re
 
 class MockApp:
     config = {'DATA_DIR': os.path.normpath(os.path.split(__file__)[0] + '/../data')}
 
 class MockDatabase:
-    def execute(self, sql):
+    def execute(self, sql, params=None):
         pass
 
     def fetchone(self):
         pass
 
+    def fetchall(self):
+        return []
+
 entity = {
   "claims": {
     "P17": [
@@ -131,12 +135,6 @@ entity = {
   "type": "item"
 }
 
-def test_get_pattern():
-    re_pattern = matcher.get_pattern('test')
-    assert re_pattern.pattern == r'\btest\b'
-
-    matcher.get_pattern('test')
-
 def test_get_osm_id_and_type():
     assert matcher.get_osm_id_and_type('point', 1) == ('node', 1)
     assert matcher.get_osm_id_and_type('line', 1) == ('way', 1)
@@ -577,3 +575,181 @@ def test_bad_building_match():
                                      [('label', 'en')])]}
 
     assert not matcher.bad_building_match(osm_tags, name_match, item)
+
+def test_search_criteria():
+    criteria = matcher.search_criteria(['building', 'historic=city_gate'])
+    assert criteria == [('building', None),
+                        ('historic', 'city_gate'),
+                        ('historic', 'city gate')]
+
+class MockBatchCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.closed = False
+
+    def execute(self, sql, params):
+        self.params = params
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        self.closed = True
+
+class MockConnection:
+    def __init__(self, rows):
+        self.batch_cursor = MockBatchCursor(rows)
+
+    def cursor(self, name=None):
+        return self.batch_cursor
+
+def test_find_batch_item_matches(monkeypatch):
+    monkeypatch.setattr(matcher, 'current_app', MockApp)
+
+    mall_entity = {
+        'claims': {},
+        'labels': {'en': {'language': 'en', 'value': 'Oxmoor Center'}},
+        'sitelinks': {},
+    }
+    mall_tags = {'landuse': 'retail', 'name': 'Oxmoor Mall'}
+
+    no_match_entity = {
+        'claims': {},
+        'labels': {'en': {'language': 'en', 'value': 'Test Library'}},
+        'sitelinks': {},
+    }
+
+    mall = Item(item_id=1, entity=mall_entity, tags=['landuse=retail'])
+    no_names = Item(item_id=2, entity={'claims': {}, 'labels': {},
+                                       'sitelinks': {}})
+    no_match = Item(item_id=3, entity=no_match_entity, tags=['amenity=library'])
+
+    rows = [(1, 0, 'polygon', 59847542, None, mall_tags, 0)]
+    mock_db = MockDatabase()
+    mock_db.connection = MockConnection(rows)
+
+    items = [mall, no_names, no_match]
+    found = list(matcher.find_batch_item_matches(mock_db, items, 'prefix'))
+
+    assert [item for item, candidates in found] == items
+    assert len(found[0][1]) == 1
+    assert found[0][1][0]['osm_id'] == 59847542
+    assert found[1][1] == []
+    assert found[2][1] == []
+
+    params = mock_db.connection.batch_cursor.params
+    assert len(params['max_dist']) == 2  # item without names isn't searched
+    assert ('landuse', 'retail') in zip(params['criteria_key'],
+                                        params['criteria_value'])
+    assert mock_db.connection.batch_cursor.closed
+
+def test_add_candidate_geoms():
+    class MockGeomCursor:
+        def execute(self, sql, params):
+            self.sql, self.params = sql, params
+
+        def fetchall(self):
+            return [('polygon', 1, 'POLYGON((0 0,0 1,1 1,0 0))')]
+
+    candidates = [
+        {'planet_table': 'polygon', 'src_id': 1, 'geom': None},
+        {'planet_table': 'point', 'src_id': 2, 'geom': None},
+    ]
+    cur = MockGeomCursor()
+    matcher.add_candidate_geoms(cur, candidates, 'prefix')
+
+    assert cur.params == {'point': [2], 'polygon': [1]}
+    assert 'ST_SimplifyPreserveTopology' in cur.sql
+    assert candidates[0]['geom'] == 'POLYGON((0 0,0 1,1 1,0 0))'
+    assert candidates[1]['geom'] is None
+
+    sql = matcher.candidate_geom_sql('prefix', ['line'], simplify=False)
+    assert 'ST_SimplifyPreserveTopology' not in sql
+
+def test_item_fingerprint(monkeypatch):
+    monkeypatch.setattr(matcher, 'current_app', MockApp)
+    monkeypatch.setattr(Item, 'place_names', lambda item: {'Oxford'})
+
+    entity = {
+        'claims': {},
+        'labels': {'en': {'language': 'en', 'value': 'Test Church'}},
+        'sitelinks': {},
+    }
+
+    item = Item(item_id=1, entity=entity, tags=['amenity=place_of_worship'])
+    same = Item(item_id=1, entity=entity, tags=['amenity=place_of_worship'])
+    assert matcher.item_fingerprint(item) == matcher.item_fingerprint(same)
+
+    other_tags = Item(item_id=1, entity=entity, tags=['building=church'])
+    assert matcher.item_fingerprint(item) != matcher.item_fingerprint(other_tags)
+
+    renamed = dict(entity, labels={'en': {'language': 'en', 'value': 'St Mary'}})
+    other_name = Item(item_id=1, entity=renamed, tags=['amenity=place_of_worship'])
+    assert matcher.item_fingerprint(item) != matcher.item_fingerprint(other_name)
+
+def test_entity_type_index(monkeypatch):
+    monkeypatch.setattr(matcher, 'current_app', MockApp)
+    entity_types = matcher.load_entity_types()
+    index = matcher.EntityTypeIndex(entity_types)
+
+    for t in entity_types:
+        tags = set(t['tags'])
+        endings = set()
+        max_dists = []
+        for other in entity_types:
+            if tags & set(other['tags']):
+                endings.update(other.get('trim', []))
+                if other.get('dist'):
+                    max_dists.append(other['dist'])
+        assert index.endings_for_tags(tags) == endings
+        assert index.max_dist_for_tags(tags) == (max(max_dists) if max_dists else None)
+
+    assert index.endings_for_tags({'no_such=tag'}) == set()
+    assert index.max_dist_for_tags([]) is None
+
+    assert index.could_be_building({'amenity=library'}, [])
+    assert index.could_be_building(set(), ['Q7075'])  # library
+    assert not index.could_be_building({'amenity=library'}, ['Q1785071'])  # fort
+
+def test_categories_to_tags(monkeypatch):
+    monkeypatch.setattr(matcher, 'current_app', MockApp)
+    cat_to_entity = matcher.build_cat_map()
+
+    def scan_all_keys(cat):
+        ''' Check every category key, like categories_to_tags used to. '''
+        lc_cat = cat.lower()
+        tags = set()
+        for key, value in cat_to_entity.items():
+            if not re.search(r'\b' + re.escape(key) + r'\b', lc_cat, re.I):
+                continue
+            exclude = value.get('exclude_cats')
+            if exclude and re.search(r'\b(' + '|'.join(re.escape(e) for e in exclude) + r')\b', lc_cat, re.I):
+                continue
+            tags |= set(value['tags'])
+        return tags
+
+    categories = [
+        'Museums in Oxford',
+        'Art museums and galleries in London',
+        'Power stations in Scotland',
+        'Railway stations in Kent',
+        'Bus stations in Wales',
+        'Public houses in Bristol',
+        'Docks (maritime) of England',
+        'Battles involving France',
+        "Women's museums",
+        'Populated places in Texas',
+        'Grade I listed churches in Devon',
+        'Nothing to see here',
+    ]
+    categories += [cat for value in cat_to_entity.values() for cat in value['cats']]
+
+    classifier = matcher.CategoryClassifier(cat_to_entity)
+    for cat in categories:
+        assert classifier.tags(cat) == scan_all_keys(cat)
+
+    expect = sorted(set.union(*[scan_all_keys(cat) for cat in categories]))
+    assert matcher.categories_to_tags(categories) == expect
+
+    tags_map = matcher.categories_to_tags_map(['Museums in Oxford', 'Nothing to see here'])
+    assert list(tags_map.keys()) == ['Museums in Oxford']
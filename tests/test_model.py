@@ -1,5 +1,6 @@
 from matcher.model import Item
-from matcher import matcher
+from matcher import matcher, model
+from sqlalchemy.dialects import postgresql
 import os.path
 
 class MockApp:
@@ -63,3 +64,28 @@ def test_calculate_tags(monkeypatch):
     result = item.calculate_tags()
     assert 'building' not in result
     assert result == tags | {'leisure=park'}
+
+def test_upsert_candidates(monkeypatch):
+    executed = []
+
+    class MockSession:
+        def execute(self, stmt, params=None):
+            executed.append(stmt)
+
+    monkeypatch.setattr(model, 'session', MockSession())
+
+    candidate = {'osm_type': 'way', 'osm_id': 1, 'name': 'Test', 'dist': 5.0,
+                 'tags': {'name': 'Test'}, 'planet_table': 'polygon',
+                 'src_id': 1, 'geom': 'POINT(0 0)', 'matching_tags': set()}
+    model.upsert_candidates({100: [candidate, candidate], 200: []})
+
+    assert len(executed) == 1
+    sql = str(executed[0].compile(dialect=postgresql.dialect()))
+    assert 'ON CONFLICT (item_id, osm_id, osm_type) DO UPDATE' in sql
+    assert 'matching_tags' not in sql
+    # the duplicate candidate is only inserted once
+    assert sql.count('ST_GeogFromText') == 1
+
+    executed.clear()
+    model.upsert_candidates({100: []})
+    assert executed == []
@@ -0,0 +1,42 @@
+from matcher import netstring
+import socket
+import pytest
+
+def test_round_trip():
+    a, b = socket.socketpair()
+    reader = netstring.Reader(b)
+    netstring.write(a, 'ack')
+    netstring.write_many(a, ['{"type": "chunk"}', '', 'Zürich'])
+    a.close()
+
+    assert reader.read() == 'ack'
+    assert reader.read() == '{"type": "chunk"}'
+    assert reader.read() == ''
+    assert reader.read() == 'Zürich'
+    assert reader.read() is None
+
+def test_encode():
+    assert netstring.encode('ack') == b'3:ack,'
+    assert netstring.encode('Zürich') == b'7:Z\xc3\xbcrich,'
+
+def test_message_split_across_packets():
+    a, b = socket.socketpair()
+    reader = netstring.Reader(b)
+    for piece in (b'1', b'1:hello', b' worl', b'd', b',2:ok,'):
+        a.sendall(piece)
+    a.close()
+
+    assert reader.read() == 'hello world'
+    assert reader.read() == 'ok'
+    assert reader.read() is None
+
+@pytest.mark.parametrize('data', [b'100:too long,', b'12345678901:', b'x:bad,',
+                                  b'3:abc.', b'5:abc'])
+def test_bad_input(data):
+    a, b = socket.socketpair()
+    reader = netstring.Reader(b, max_length=10)
+    a.sendall(data)
+    a.close()
+
+    with pytest.raises(netstring.NetstringError):
+        reader.read()
@@ -1,5 +1,8 @@
+from matcher import overpass
 from matcher.overpass import oql_from_tag, oql_for_area, group_tags
 from pprint import pprint
+import gzip
+import pytest
 
 tags = ['admin_level', 'amenity=arts_centre',
         'amenity=astronomical_observatory', 'amenity=bar', 'amenity=clock',
@@ -102,3 +105,135 @@ def test_group_tags():
     }
 
     assert ret == expect
+
+class MockResponse:
+    def __init__(self, chunks, status_code=200):
+        self.chunks = chunks
+        self.status_code = status_code
+
+    def iter_content(self, chunk_size):
+        return iter(self.chunks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+def test_download(monkeypatch, tmpdir):
+    chunks = [b'<osm>', b'<node/>' * 1000, b'</osm>']
+    monkeypatch.setattr(overpass, 'endpoint', lambda url: url)
+    monkeypatch.setattr(overpass.requests, 'post',
+                        lambda *args, **kwargs: MockResponse(chunks))
+
+    filename = str(tmpdir.join('test.xml'))
+    overpass.download('', filename)
+    assert open(filename, 'rb').read() == b''.join(chunks)
+
+    filename = str(tmpdir.join('test.osm.gz'))
+    overpass.download('', filename)
+    assert gzip.open(filename).read() == b''.join(chunks)
+    assert len(tmpdir.listdir()) == 2
+
+def test_download_error(monkeypatch, tmpdir):
+    chunks = [b'<osm>', b'<node/>' * 1000,
+              b'<remark> runtime error: Query timed out </remark></osm>']
+    monkeypatch.setattr(overpass, 'endpoint', lambda url: url)
+    monkeypatch.setattr(overpass.requests, 'post',
+                        lambda *args, **kwargs: MockResponse(chunks))
+
+    filename = str(tmpdir.join('test.xml'))
+    with pytest.raises(overpass.OverpassError) as e:
+        overpass.download('', filename)
+    assert b'runtime error' in e.value.r._content
+    assert not tmpdir.listdir()
+
+def test_split_oql():
+    oql = oql_for_area('rel', 295355, ['amenity=library'],
+                       '52.000000,0.000000,53.000000,2.000000', '')
+    assert overpass.oql_bbox(oql) == (52, 53, 0, 2)
+
+    quarters = [overpass.oql_bbox(q) for q in overpass.split_oql(oql)]
+    assert quarters == [(52, 52.5, 0, 1), (52, 52.5, 1, 2),
+                        (52.5, 53, 0, 1), (52.5, 53, 1, 2)]
+
+def test_part_filename():
+    assert overpass.part_filename('overpass/1_000_004.xml', 'part0_1') == \
+        'overpass/1_000_004.part0_1.xml'
+    assert overpass.part_filename('1.osm.gz', 'merge') == '1.merge.osm.gz'
+
+def test_download_split(monkeypatch, tmpdir):
+    class ErrorResponse:
+        status_code = 200
+        content = b'<remark> runtime error: Query run out of memory </remark>'
+
+    def mock_download(oql, filename, url=None):
+        south, north, west, east = overpass.oql_bbox(oql)
+        if north - south > 0.5:
+            raise overpass.OverpassError(ErrorResponse())
+        open(filename, 'w').write(oql)
+
+    merged = []
+    def mock_merge(files, filename):
+        merged.append([open(f).read() for f in files])
+        open(filename, 'w').write('merged')
+
+    monkeypatch.setattr(overpass, 'download', mock_download)
+    monkeypatch.setattr(overpass, 'merge_files', mock_merge)
+
+    oql = oql_for_area('rel', 295355, ['amenity=library'],
+                       '52.000000,0.000000,53.000000,2.000000', '')
+    filename = str(tmpdir.join('1_000_004.xml'))
+    splits = []
+    assert overpass.download_split(oql, filename, on_split=splits.append) == filename
+    assert splits == [(52, 53, 0, 2)]
+    assert len(merged[0]) == 4
+    assert tmpdir.listdir() == [tmpdir.join('1_000_004.xml')]
+
+def test_normalize_oql():
+    a = '[timeout:300][out:json];\n  node[wikidata=Q1];\n\nout  qt;\n'
+    b = '[timeout:600][out:json];\nnode[wikidata=Q1];\nout qt;'
+    assert overpass.normalize_oql(a) == overpass.normalize_oql(b)
+    assert overpass.cache_key(a) != overpass.cache_key(a.replace('Q1', 'Q2'))
+
+def test_download_cached(monkeypatch, tmpdir):
+    cache = overpass.disk_cache.DiskCache(str(tmpdir.join('cache')), budget=10 ** 6, ttl=60)
+    monkeypatch.setattr(overpass, 'get_cache', lambda: cache)
+    monkeypatch.setattr(overpass, 'endpoint', lambda url: url)
+    posts = []
+    def mock_post(*args, **kwargs):
+        posts.append(args)
+        return MockResponse([b'<osm/>'])
+    monkeypatch.setattr(overpass.requests, 'post', mock_post)
+
+    for name in 'a.xml', 'b.xml':
+        filename = str(tmpdir.join(name))
+        overpass.download('node(1);out;', filename)
+        assert open(filename, 'rb').read() == b'<osm/>'
+    assert len(posts) == 1
+
+    def failed_post(*args, **kwargs):
+        return MockResponse([b'<title>504 Gateway'])
+    monkeypatch.setattr(overpass.requests, 'post', failed_post)
+    cache.ttl = -1
+    cache.store_file(overpass.cache_key('node(1);out;', '.xml'),
+                     str(tmpdir.join('a.xml')))
+    filename = str(tmpdir.join('c.xml'))
+    overpass.download('node(1);out;', filename)
+    assert open(filename, 'rb').read() == b'<osm/>'
+
+def test_forget(monkeypatch, tmpdir):
+    cache = overpass.disk_cache.DiskCache(str(tmpdir), budget=10 ** 6, ttl=60)
+    monkeypatch.setattr(overpass, 'get_cache', lambda: cache)
+    oql = oql_for_area('rel', 295355, ['amenity=library'],
+                       '52.000000,0.000000,53.000000,2.000000', '')
+    part_oql = overpass.split_oql(overpass.split_oql(oql)[1])[2]
+    for q in oql, part_oql:
+        cache.store(overpass.download_key(q, '1_000_004.xml'), b'<osm/>')
+    other = overpass.download_key(oql, '1.osm.gz')
+    cache.store(other, b'<osm/>')
+
+    overpass.forget(oql, '1_000_004.xml')
+    assert cache.lookup(overpass.download_key(oql, '1_000_004.xml')) is None
+    assert cache.lookup(overpass.download_key(part_oql, '1_000_004.xml')) is None
+    assert cache.lookup(other)
@@ -1,5 +1,6 @@
 from matcher.model import Item
-from matcher.place import Place
+from matcher.place import Place, search_bbox, bbox_overlap, bbox_area, quadtree_chunks
+from flask import Flask
 from matcher import database
 
 def simple_place():
@@ -60,3 +61,71 @@ def test_place_country_code(app):
                      'country_code': 'us'}
     assert place.country_code == 'us'
     assert place.get_address_key('missing key') is None
+
+def test_search_bbox():
+    south, north, west, east = search_bbox(0, 0, 1000)
+    assert round(north * 111.32, 3) == 1
+    assert south == -north and west == -east
+
+    south, north, west, east = search_bbox(60, 0, 1000)
+    assert round(east * 111.32 / 2, 3) == 1  # a degree of longitude is half as long
+
+    item = (51.45, 51.46, -2.63, -2.62)
+    assert bbox_overlap(item, (51.0, 51.5, -3.0, -2.5))
+    assert bbox_overlap(item, (51.46, 52.0, -2.62, -2.0))  # touching corner
+    assert not bbox_overlap(item, (51.47, 52.0, -3.0, -2.5))
+    assert not bbox_overlap(item, (51.0, 52.0, -2.5, -2.0))
+
+def test_osm2pgsql_cmd():
+    app = Flask('test_osm2pgsql_cmd')
+    app.config.update(DB_HOST='localhost', DB_USER='test', DB_NAME='test')
+    place = simple_place()
+    with app.app_context():
+        create = place.osm2pgsql_cmd('a.xml')
+        keep = place.osm2pgsql_cmd('a.xml', keep_slim=True)
+        append = place.osm2pgsql_cmd('b.xml', append=True)
+
+    assert create[1:3] == ['--create', '--drop']
+    assert keep[1:3] == ['--create', '--slim']
+    assert append[1:3] == ['--append', '--slim']
+    assert append[-1] == 'b.xml'
+
+def test_bbox_area():
+    assert round(bbox_area((0, 1, 0, 1))) == 12392
+    assert round(bbox_area((59.5, 60.5, 0, 1))) == 6196
+
+def test_quadtree_chunks():
+    bbox = (0, 1, 0, 1)
+    # a cluster of points in the south-west corner
+    points = [(0.1 + i / 1000, 0.1 + i / 1000) for i in range(100)]
+
+    def too_big(bbox, item_count):
+        return item_count > 10
+
+    chunks = list(quadtree_chunks(bbox, points, too_big))
+    assert len(chunks) > 4
+    assert (0.5, 1.0, 0.5, 1.0) in chunks  # empty quarter isn't split
+    assert min(bbox_area(c) for c in chunks) < bbox_area(bbox) / 16
+    assert round(sum(bbox_area(c) for c in chunks)) == round(bbox_area(bbox))
+
+    def never(bbox, item_count):
+        return False
+    assert list(quadtree_chunks(bbox, points, never)) == [bbox]
+
+    def always(bbox, item_count):
+        return True
+    assert len(list(quadtree_chunks(bbox, [], always))) == 4 ** 6
+
+def test_chunk_filename():
+    place = simple_place()
+    old_plan = [(0, 1, 0, 1), (0, 1, 1, 2)]
+    new_plan = [(0, 0.5, 0, 1), (0, 1, 1, 2)]
+
+    assert place.chunk_filename(0, old_plan[:1]) == '1.xml'
+    assert place.chunk_filename(0, old_plan).startswith('1_000_002_')
+    assert place.chunk_filename(0, old_plan) != place.chunk_filename(0, new_plan)
+    assert place.chunk_filename(1, old_plan) == place.chunk_filename(1, new_plan)
+    app = Flask('test_chunk_filename')
+    app.config.update(OVERPASS_DIR='overpass')
+    with app.app_context():
+        assert place.is_overpass_filename(place.chunk_filename(0, old_plan))
@@ -0,0 +1,79 @@
+from matcher import websocket, place
+from matcher.place import Place
+from collections import Counter
+from flask import Flask
+
+class MockQuery(list):
+    def count(self):
+        return len(self)
+
+class MockPlace:
+    ''' Items in memory, the first matcher run for a place. '''
+    run_matcher = Place.run_matcher
+    prefix = 'osm_1'
+
+    def __init__(self, item_chunk):
+        self.item_chunk = item_chunk  # item_id -> bbox of the chunk with its OSM data
+        self.done = {item_id: None for item_id in item_chunk}
+        self.matched = Counter()
+        self.items = MockQuery(item_chunk)
+
+    def mark_changed_items_not_done(self, check_osm=True):
+        for item_id in self.done:  # no fingerprints yet
+            self.done[item_id] = False
+
+    def mark_items_near_changed_osm_not_done(self):
+        pass  # no digest from a previous run
+
+    def matcher_query(self):
+        return MockQuery(i for i, done in self.done.items() if not done)
+
+    def items_clear_of(self, pending):
+        return [i for i in self.matcher_query() if self.item_chunk[i] not in pending]
+
+    def match_place_items(self, place_items, **kwargs):
+        for item_id in place_items:
+            self.matched[item_id] += 1
+            self.done[item_id] = True
+
+    def osm2pgsql_cmd(self, *args, **kwargs):
+        return ['true']
+
+    def drop_slim_tables(self):
+        pass
+
+    def items_with_candidates_count(self):
+        return 0
+
+class MockSocket:
+    def __init__(self, place):
+        self.place = place
+
+    def status(self, msg):
+        pass
+
+    def item_progress(self, candidates, item):
+        pass
+
+def test_pipelined_run_matches_each_item_once(monkeypatch, tmpdir):
+    chunks = [{'num': num, 'oql': 'node;', 'filename': f'1_{num:03d}_3.xml',
+               'bbox': num}
+              for num in range(3)]
+    for chunk in chunks:
+        tmpdir.join(chunk['filename']).write('<osm/>')
+    mock_place = MockPlace({1: 0, 2: 1, 3: 2, 4: 2})
+
+    monkeypatch.setattr(websocket.subprocess, 'run', lambda *args, **kwargs: None)
+    monkeypatch.setattr(place, 'get_tables', lambda: [])
+    monkeypatch.setattr(place.session, 'commit', lambda: None)
+
+    app = Flask('test')
+    app.config.update(OVERPASS_DIR=str(tmpdir), DB_PASS='')
+    with app.app_context():
+        loader = websocket.ChunkLoader(MockSocket(mock_place), chunks)
+        for num in 2, 0, 1:
+            loader.chunk_done(num)
+        loader.finish()
+        mock_place.run_matcher(reset=False)
+
+    assert mock_place.matched == {1: 1, 2: 1, 3: 1, 4: 1}
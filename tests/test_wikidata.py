@@ -1,4 +1,10 @@
 from matcher import wikidata
+from flask import Flask
+from matcher.disk_cache import DiskCache
+from collections import OrderedDict, Counter
+import gzip
+import threading
+import time
 import pytest
 import vcr
 
@@ -524,3 +530,179 @@ def test_parse_enwiki_query():
     }
 
     assert wikidata.parse_enwiki_query(rows) == expect
+
+class MockAPIResponse:
+    def __init__(self, json_data, status_code=200, headers=None):
+        self.json_data = json_data
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def json(self):
+        return self.json_data
+
+    def raise_for_status(self):
+        pass
+
+def test_entity_iter(monkeypatch):
+    ids = ['Q{}'.format(num) for num in range(1, 131)]
+    calls = []
+
+    class MockSession:
+        def get(self, url, params):
+            assert params['maxlag'] == wikidata.maxlag
+            calls.append(params['ids'])
+            if len(calls) == 1:
+                return MockAPIResponse({'error': {'code': 'maxlag'}},
+                                       headers={'Retry-After': '0'})
+            if len(calls) == 2:
+                return MockAPIResponse({}, status_code=429,
+                                       headers={'Retry-After': '0'})
+            entities = {qid: {'id': qid} for qid in params['ids'].split('|')}
+            return MockAPIResponse({'entities': entities})
+
+    monkeypatch.setattr(wikidata, 'api_session', MockSession)
+    found = [qid for qid, entity in wikidata.entity_iter(ids, workers=1)]
+    assert found == ids
+    assert len(calls) == 5
+
+def test_api_get_error(monkeypatch):
+    error = {'code': 'no-such-entity', 'info': 'Could not find an entity'}
+
+    class MockSession:
+        def get(self, url, params):
+            return MockAPIResponse({'error': error})
+
+    monkeypatch.setattr(wikidata, 'api_session', MockSession)
+
+    with pytest.raises(wikidata.APIError):
+        wikidata.api_get({'action': 'wbgetentities', 'ids': 'Qx'})
+
+def test_updated_entity_iter(monkeypatch):
+    revisions = {'Q1': 10, 'Q2': 20, 'Q3': 30}
+    full_fetch = []
+
+    class MockSession:
+        def get(self, url, params):
+            ids = params['ids'].split('|')
+            if params.get('props') != 'info':
+                full_fetch.extend(ids)
+            entities = {qid: {'id': qid, 'lastrevid': revisions[qid]}
+                        for qid in ids}
+            return MockAPIResponse({'entities': entities})
+
+    monkeypatch.setattr(wikidata, 'api_session', MockSession)
+    known = {'Q1': 10, 'Q2': 19, 'Q3': None}
+    found = dict(wikidata.updated_entity_iter(known))
+    assert sorted(found) == ['Q2', 'Q3']
+    assert sorted(full_fetch) == ['Q2', 'Q3']
+
+def test_project_entity():
+    entity = wikidata.project_entity(test_entity, {'P31', 'P373', 'P625'})
+    assert entity['projection'] == wikidata.entity_projection_version
+    assert set(entity['claims']) == {'P31', 'P373', 'P625'}
+    assert entity['claims']['P373'] == [
+        {'mainsnak': {'datavalue': {'value': 'Eiffel Tower'}}}]
+    assert 'badges' not in entity['sitelinks']['dewiki']
+    assert wikidata.names_from_entity(entity) == \
+        wikidata.names_from_entity(test_entity)
+
+    item = wikidata.WikidataItem('Q243', entity)
+    assert item.coords == (48.8583, 2.2944)
+    assert item.is_a == ['Q1440476', 'Q1440300', 'Q2319498']
+    assert wikidata.project_entity(entity) is entity
+
+def test_bbox_items(monkeypatch):
+    def enwiki_row(qid, title):
+        return {'place': {'type': 'uri', 'value': wikidata.wd_entity + qid[1:]},
+                'placeLabel': {'value': title},
+                'article': {'value': wikidata.enwiki + title},
+                'location': {'value': 'Point(2.2953 48.858)'}}
+
+    replies = {
+        'enwiki': [enwiki_row('Q1', 'One')],
+        'enwiki_hq': [enwiki_row('Q2', 'Two')],
+        'item_tag': [{'place': {'type': 'uri', 'value': wikidata.wd_entity + '1'},
+                      'tag': {'value': 'Tag:amenity=library'}}],
+    }
+
+    def mock_run_query(query, kind='default'):
+        assert kind is None  # bbox queries skip the cache
+        if query not in replies:
+            raise wikidata.QueryTimeout(query, None)
+        return replies[query]
+
+    for name in 'enwiki', 'enwiki_hq', 'item_tag', 'hq_item_tag':
+        monkeypatch.setattr(wikidata, f'get_{name}_query', lambda *args, name=name: name)
+    monkeypatch.setattr(wikidata, 'run_query', mock_run_query)
+
+    with Flask('test').app_context():
+        items = wikidata.bbox_items((48, 49, 2, 3))
+    assert sorted(items) == ['Q1', 'Q2']
+    assert items['Q1']['tags'] == {'amenity=library'}
+
+    del replies['item_tag']
+    with Flask('test').app_context():
+        with pytest.raises(wikidata.QueryTimeout):
+            wikidata.bbox_items((48, 49, 2, 3))
+
+def test_run_query_cache(monkeypatch, tmpdir):
+    cache = DiskCache(str(tmpdir), budget=10 ** 6, ttl=60)
+    monkeypatch.setattr(wikidata, 'query_cache', lambda: cache)
+    monkeypatch.setattr(wikidata, 'memory_cache', OrderedDict())
+    monkeypatch.setattr(wikidata, 'cache_stats', Counter())
+    posts = []
+
+    class MockQueryResponse:
+        def json(self):
+            return {'results': {'bindings': [{'n': len(posts)}]}}
+
+    def mock_post_query(query, timeout=None, send_error_mail=True):
+        posts.append(query)
+        return MockQueryResponse()
+
+    monkeypatch.setattr(wikidata, 'post_query', mock_post_query)
+    query = 'SELECT ?item WHERE {\n  ?item wdt:P31 wd:Q5 .\n}'
+
+    assert wikidata.run_query(query) == [{'n': 1}]
+    assert wikidata.run_query('  ' + query.replace('\n', '\n\n')) == [{'n': 1}]
+    wikidata.memory_cache.clear()
+    assert wikidata.run_query(query) == [{'n': 1}]
+    assert wikidata.run_query(query, kind=None) == [{'n': 2}]
+    assert len(posts) == 2
+    assert wikidata.cache_stats == {'miss': 1, 'memory_hit': 1, 'hit': 2}
+
+    def failed_post_query(query, timeout=None, send_error_mail=True):
+        raise wikidata.QueryTimeout(query, None)
+
+    monkeypatch.setitem(wikidata.query_cache_ttl, 'default', -1)
+    query = 'SELECT ?item WHERE { ?item wdt:P31 wd:Q515 . }'
+    assert wikidata.run_query(query) == [{'n': 3}]
+    monkeypatch.setattr(wikidata, 'post_query', failed_post_query)
+    assert wikidata.run_query(query) == [{'n': 3}]  # stale, query failed
+
+def test_run_query_revalidate(monkeypatch, tmpdir):
+    cache = DiskCache(str(tmpdir), budget=10 ** 6, ttl=60)
+    monkeypatch.setattr(wikidata, 'query_cache', lambda: cache)
+    monkeypatch.setattr(wikidata, 'memory_cache', OrderedDict())
+    monkeypatch.setattr(wikidata, 'cache_stats', Counter())
+    key = wikidata.hash_key(wikidata.normalize_query('SELECT ?up'))
+    cache.store(key, gzip.compress(b'[{"n": "stale"}]'), ttl=-1)
+    refreshed = threading.Event()
+
+    class MockQueryResponse:
+        def json(self):
+            refreshed.set()
+            return {'results': {'bindings': [{'n': 'new'}]}}
+
+    monkeypatch.setattr(wikidata, 'post_query',
+                        lambda query, **kwargs: MockQueryResponse())
+
+    with Flask('test').app_context():
+        assert wikidata.run_query('SELECT ?up', kind='browse') == [{'n': 'stale'}]
+    assert refreshed.wait(5)
+    for attempt in range(50):
+        if not wikidata.revalidating:
+            break
+        time.sleep(0.1)
+    assert wikidata.run_query('SELECT ?up', kind='browse') == [{'n': 'new'}]
+    assert wikidata.cache_stats['stale'] == 1